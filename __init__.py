@@ -3,42 +3,87 @@ from deploy  import *
 import drush
 import behat
 import patternlab
+import helpers as h
+import timeline
 from .environments import e
 
 from fabric.api import task, env, execute
 
-from fabric.colors import red
+from fabric.colors import red, green
+from fabric.utils import abort
 from fabric.contrib.console import confirm
 
 @task
 def init():
     """
     Complete local installation process, used generally when building the docker image for install and configure Drupal.
+    If a pool of containers was started with "fab docker.pool_start", one of them is leased instead.
     """
 
+    lease = docker.docker_pool_lease()
+    if lease:
+        env.container_ip = lease['ip']
+        h.fab_update_container_ip(env.container_ip)
+        execute(drush.aliases)
+        print(green('Docker container {} was leased from the pool, it is available at http://localhost:{}. '
+                    'Run "fab docker.pool_release:{}" to give it back.'.format(lease['name'], lease['port'],
+                                                                              lease['name'])))
+        return
+
     execute(docker.image_create)
     execute(docker.container_start)
+    execute(docker.container_ready)
     execute(drush.make, 'install')
     execute(drush.site_install, host='root@{}'.format(env.container_ip))
     execute(drush.aliases)
     execute(behat.init, host='root@{}'.format(env.container_ip))
+    h.ssh_report()
 
 
 
 @task
-def test(tags=''):
+def test(tags='', shards=1):
     """
     Setup Behat and run the complete tests suite. Default output formatters: pretty and JUnit.
     The JUnit report file is specified in the Behat configuration file. Default: tests/behat/out/behat.junit.xml.
+    If a pool of containers was started with "fab docker.pool_start", the tests run in a leased container.
 
     :param tags Specific Behat tests tags to run.
+    :param shards Number of pool containers to split the suite across, their JUnit reports are merged.
 
     """
-    execute(behat.init)
-    if not tags:
-      execute(behat.run)
-    else:
-      execute(behat.run, tags='{}'.format(tags))
+    if int(shards) > 1:
+        leases = []
+        try:
+            for i in range(int(shards)):
+                lease = docker.docker_pool_lease()
+                if not lease:
+                    break
+                leases.append(lease)
+            if len(leases) < 2:
+                abort('The sharded run needs at least 2 free containers, start a pool with "fab docker.pool_start:{}".'
+                      .format(shards))
+            hosts = ['root@{}'.format(leased['ip']) for leased in leases]
+            if tags:
+                behat.run_sharded(hosts, tags)
+            else:
+                behat.run_sharded(hosts)
+        finally:
+            for lease in leases:
+                docker.docker_pool_release(lease['name'])
+        return
+
+    lease = docker.docker_pool_lease()
+    hosts = ['root@{}'.format(lease['ip'])] if lease else None
+    try:
+        execute(behat.init, hosts=hosts)
+        if not tags:
+          execute(behat.run, hosts=hosts)
+        else:
+          execute(behat.run, tags='{}'.format(tags), hosts=hosts)
+    finally:
+        if lease:
+            docker.docker_pool_release(lease['name'])
 
 
 
@@ -81,8 +126,53 @@ def release():
 @task
 def deploy(environment):
     """Deploy code and run database updates on a target Drupal environment.
+    The platform is pushed to the hosts of the environment in parallel, by rolling batches.
+    With a shared database, the database is migrated once, from the first host.
     """
 
-    execute(provision, environment)
-    execute(push, environment, hosts=env.hosts)
-    execute(migrate, environment, hosts=env.hosts)
+    timeline.start(environment)
+    try:
+        execute(provision, environment)
+        execute_rolling(push, environment, env.hosts)
+        if env.deploy_shared_database:
+            execute(migrate, environment, hosts=env.hosts[:1])
+        else:
+            execute_rolling(migrate, environment, env.hosts)
+    except BaseException:
+        timeline.finish('failed')
+        raise
+    summary = timeline.finish()
+    h.ssh_report()
+    if summary['maintenance'] is not None:
+        print(green('The site was in maintenance for {:.2f}s.'.format(summary['maintenance'])))
+
+
+@task
+def deploy_report(count=5):
+    """
+    Compare the last deployments, flagging the phases that got slower than the previous deployments' average.
+    The timeline of each deployment is in build/deploys, with a Chrome trace export (chrome://tracing).
+    :param count Number of deployments to compare
+    """
+    summaries = timeline.history(count)
+    if not summaries:
+        print(red('No deployment recorded in {}/deploys.'.format(env.builddir)))
+        return
+
+    for summary in summaries:
+        maintenance = summary['maintenance']
+        print('{}  {:<10} {:<8} total {:8.2f}s  maintenance {}  {} byte(s) sent'.format(
+            summary['name'], summary['environment'], summary['status'], summary['end'] - summary['start'],
+            '{:8.2f}s'.format(maintenance) if maintenance is not None else '       -', summary['bytes']))
+        for name in sorted(summary['phases']):
+            print('    {:<16} {:8.2f}s'.format(name, summary['phases'][name]))
+
+    # Compare the last deployment with the average of the previous ones.
+    last, previous = summaries[-1], summaries[:-1]
+    durations = dict(last['phases'], maintenance=last['maintenance'])
+    for name, duration in sorted(durations.items()):
+        values = [s['maintenance'] if name == 'maintenance' else s['phases'].get(name) for s in previous]
+        values = [value for value in values if value is not None]
+        if duration is not None and values and duration > 1.2 * sum(values) / len(values):
+            print(red('{} took {:.2f}s in the last deployment, the average was {:.2f}s.'.format(
+                name, duration, sum(values) / len(values))))
@@ -0,0 +1,201 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from fabric.api import env, settings, hide
+from fabric.colors import green, red
+from fabric.utils import abort
+from contextlib import contextmanager
+from fnmatch import fnmatch
+
+import base64
+import json
+import os
+import tempfile
+import time
+
+import helpers as h
+
+
+#####################################################################
+# Queries to the hostmaster site                                    #
+#####################################################################
+
+# The request is passed base64 encoded as the script argument, so the script is uploaded once per host.
+HOSTMASTER_SCRIPT = """<?php
+$request = json_decode(base64_decode(drush_shift()), TRUE);
+$result = array();
+switch ($request['action']) {
+  case 'platforms':
+    foreach ($request['names'] as $name) {
+      $nid = db_query("SELECT nid FROM {hosting_context} WHERE name = :name",
+        array(':name' => 'platform_' . $name))->fetchField();
+      $task = $nid ? hosting_get_most_recent_task($nid, 'verify') : FALSE;
+      $result[$name] = array('nid' => $nid ? (int) $nid : NULL, 'verify' => $task ? (int) $task->nid : NULL);
+    }
+    break;
+
+  case 'sites':
+    $sites = db_query("SELECT s.nid, s.db_server, sc.name AS site, pc.name AS platform FROM {hosting_site} s
+      INNER JOIN {hosting_context} sc ON sc.nid = s.nid INNER JOIN {hosting_context} pc ON pc.nid = s.platform
+      WHERE s.status = :status", array(':status' => HOSTING_SITE_ENABLED));
+    foreach ($sites as $site) {
+      $result[] = array('nid' => (int) $site->nid, 'name' => $site->site, 'db_server' => (int) $site->db_server,
+        'platform' => preg_replace('/^platform_/', '', $site->platform));
+    }
+    break;
+
+  case 'migrate':
+    foreach ($request['sites'] as $site) {
+      $task = hosting_add_task($site['nid'], 'migrate', array('target_platform' => $request['platform'],
+        'new_uri' => $site['name'], 'new_db_server' => $site['db_server']));
+      $result[$site['name']] = (int) $task->nid;
+    }
+    break;
+
+  case 'status':
+    $statuses = array(HOSTING_TASK_QUEUED => 'queued', HOSTING_TASK_PROCESSING => 'processing',
+      HOSTING_TASK_SUCCESS => 'success', HOSTING_TASK_WARNING => 'warning', HOSTING_TASK_ERROR => 'error');
+    $tasks = db_query("SELECT nid, task_status FROM {hosting_task} WHERE nid IN (:nids)",
+      array(':nids' => $request['tasks']));
+    foreach ($tasks as $task) {
+      $result[$task->nid] = $statuses[$task->task_status];
+    }
+    break;
+}
+print 'DRUPALIZER_RESULT ' . json_encode($result) . "\\n";
+"""
+
+# Final statuses of the hosting tasks.
+DONE = ('success', 'warning', 'error')
+
+
+@contextmanager
+def hostmaster(role):
+    """
+    Upload the hostmaster script for the duration of the block.
+    :return: a function sending a request to the hostmaster site and returning its decoded answer
+    """
+    remote_script = '/tmp/drupalizer-hostmaster-{}.php'.format(os.getpid())
+    with tempfile.NamedTemporaryFile(suffix='.php') as f:
+        f.write(HOSTMASTER_SCRIPT.encode('utf-8'))
+        f.flush()
+        h.fab_put(role, f.name, remote_script)
+
+    def query(action, **request):
+        request['action'] = action
+        encoded = base64.b64encode(json.dumps(request).encode('utf-8')).decode('ascii')
+        with settings(hide('running', 'stdout')):
+            output = h.fab_run(role, 'drush @hostmaster php-script {} {}'.format(remote_script, encoded),
+                               capture=True)
+        for line in output.splitlines():
+            if line.startswith('DRUPALIZER_RESULT '):
+                return json.loads(line[len('DRUPALIZER_RESULT '):])
+        abort('The hostmaster site did not answer the {} request: {}'.format(action, output))
+
+    try:
+        yield query
+    finally:
+        h.fab_run(role, 'rm -f {}'.format(remote_script))
+
+
+#####################################################################
+# Hosting tasks                                                     #
+#####################################################################
+
+def run_tasks(role, query, tasks):
+    """
+    Run hosting tasks, aegir_concurrency at a time, then poll the hosting queue until they all complete.
+    Tasks picked up by the queue daemon in the meantime are skipped by hosting-task and waited for.
+    :param tasks A dict of labels, like the site names, to task nids
+    :return: a dict of labels to the final status of their task
+    """
+    if not tasks:
+        return {}
+    nids = ' '.join(str(nid) for nid in tasks.values())
+    with settings(warn_only=True):
+        h.fab_run(role, 'printf "%s\\n" {} | xargs -P {} -n 1 drush @hostmaster hosting-task'.format(
+            nids, int(env.aegir_concurrency)))
+
+    deadline = time.time() + int(env.aegir_task_timeout)
+    while True:
+        statuses = query('status', tasks=list(tasks.values()))
+        pending = [label for label, nid in tasks.items() if statuses.get(str(nid)) not in DONE]
+        if not pending:
+            break
+        if time.time() > deadline:
+            abort('Aegir tasks still pending after {}s: {}.'.format(env.aegir_task_timeout,
+                                                                    ', '.join(sorted(pending))))
+        print(green('Waiting for {} Aegir task(s) out of {}.'.format(len(pending), len(tasks))))
+        time.sleep(int(env.aegir_poll_interval))
+    return dict((label, statuses[str(nid)]) for label, nid in tasks.items())
+
+
+def _check(statuses, what):
+    failed = sorted(label for label, status in statuses.items() if status == 'error')
+    for label in sorted(label for label, status in statuses.items() if status == 'warning'):
+        print(red('The {} of {} completed with warnings.'.format(what, label)))
+    if failed:
+        abort('The {} failed for: {}.'.format(what, ', '.join(failed)))
+
+
+def provision_platforms(role, platforms, aegir_path, aegir_destsrv):
+    """
+    Save and import several platforms in Aegir, then run their verify tasks concurrently.
+    :param platforms The platform names
+    :param aegir_path The path to the home of aegir, usually in /var/aegir
+    :param aegir_destsrv The destination webserver of the platforms
+    """
+    cmds = []
+    for platform in platforms:
+        cmds.append('drush --root="{}/platforms/{}" provision-save "@platform_{}" --context_type="platform" '
+                    '--web_server=@{}'.format(aegir_path, platform, platform, aegir_destsrv))
+        cmds.append('drush @hostmaster hosting-import platform_{}'.format(platform))
+    h.fab_run_batch(role, cmds)
+
+    with hostmaster(role) as query:
+        imported = query('platforms', names=list(platforms))
+        missing = [platform for platform in platforms if not imported[platform]['verify']]
+        if missing:
+            abort('Aegir did not queue the verification of: {}.'.format(', '.join(missing)))
+        _check(run_tasks(role, query, dict((platform, imported[platform]['verify']) for platform in platforms)),
+               'verification')
+    print(green('{} platform(s) verified in Aegir.'.format(len(platforms))))
+
+
+def migrate_sites(role, pattern, platform):
+    """
+    Migrate the sites of the platforms matching pattern to platform, aegir_concurrency sites at a time.
+    :param pattern A shell pattern of the platform names, like myproject_dev_*
+    :param platform The name of the platform to migrate the sites to
+    :return: a dict of site names to the status of their migration
+    """
+    with hostmaster(role) as query:
+        target = query('platforms', names=[platform])[platform]['nid']
+        if not target:
+            abort('The platform {} is not known by Aegir.'.format(platform))
+        sites = [site for site in query('sites')
+                 if fnmatch(site['platform'], pattern) and site['platform'] != platform]
+        if not sites:
+            print(green('No site to migrate to {}.'.format(platform)))
+            return {}
+        print(green('Migrating {} site(s) to {}, {} at a time.'.format(len(sites), platform, env.aegir_concurrency)))
+        statuses = run_tasks(role, query, query('migrate', sites=sites, platform=target))
+    _check(statuses, 'migration')
+    print(green('{} site(s) migrated to {}.'.format(len(statuses), platform)))
+    return statuses
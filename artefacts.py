@@ -0,0 +1,269 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from contextlib import closing
+from os import path
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tarfile
+import time
+
+
+#####################################################################
+# Per-file manifests of the platform archives                       #
+#####################################################################
+
+# Name of the file recording the manifest last extracted in a directory.
+TREE_STATE = '.drupalizer-manifest.json'
+
+
+def manifest_path(tarball):
+    return '{}.manifest.json'.format(tarball)
+
+
+def write_manifest(tarball):
+    """
+    Write the manifest of an archive: the type, content hash or link target, and mode of each member.
+    """
+    manifest = {}
+    with closing(tarfile.open(tarball)) as archive:
+        for member in archive:
+            if member.isfile():
+                digest = hashlib.sha1()
+                with closing(archive.extractfile(member)) as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(chunk)
+                manifest[member.name] = ['file', digest.hexdigest(), member.mode]
+            elif member.issym() or member.islnk():
+                manifest[member.name] = ['link', member.linkname, member.mode]
+            elif member.isdir():
+                manifest[member.name] = ['dir', '', member.mode]
+    with open(manifest_path(tarball), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def read_manifest(tarball):
+    if not path.isfile(manifest_path(tarball)):
+        return None
+    with open(manifest_path(tarball)) as f:
+        return json.load(f)
+
+
+def _stat(filename):
+    try:
+        stat = os.lstat(filename)
+    except OSError:
+        return None
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def record_tree(tarball, directory):
+    """
+    Record the manifest of the archive extracted in directory, with the size and modification time of each file.
+    Files modified afterwards are detected and extracted again by the next incremental extraction.
+    """
+    manifest = read_manifest(tarball)
+    if manifest is None:
+        return
+    stats = dict((name, _stat(path.join(directory, name))) for name in manifest)
+    with open(path.join(directory, TREE_STATE), 'w') as f:
+        json.dump({'manifest': manifest, 'stats': stats}, f)
+
+
+def extract_incremental(tarball, directory):
+    """
+    Update a directory holding a previously extracted archive to the content of tarball, only writing,
+    deleting or changing the mode of the files that differ.
+    :return: a dict with the number of written, deleted and chmoded paths, or None if the archive or the
+    directory lack a manifest and must be fully extracted
+    """
+    manifest = read_manifest(tarball)
+    state_file = path.join(directory, TREE_STATE)
+    if manifest is None or not path.isfile(state_file):
+        return None
+    with open(state_file) as f:
+        state = json.load(f)
+    old, stats = state['manifest'], state['stats']
+
+    write, chmod = set(), []
+    for name, entry in manifest.items():
+        previous = old.get(name)
+        modified = entry[0] != 'dir' and stats.get(name) != _stat(path.join(directory, name))
+        if previous is None or previous[:2] != entry[:2] or modified:
+            write.add(name)
+        elif previous[2] != entry[2]:
+            chmod.append(name)
+    delete = [name for name in old if name not in manifest]
+
+    # Remove what the new archive does not have, deepest paths first so directories are empty when removed.
+    for name in sorted(delete, reverse=True):
+        filename = path.join(directory, name)
+        if old[name][0] == 'dir':
+            if path.isdir(filename) and not os.listdir(filename):
+                os.rmdir(filename)
+        elif path.lexists(filename):
+            os.remove(filename)
+    if write:
+        with closing(tarfile.open(tarball)) as archive:
+            for member in archive:
+                if member.name in write:
+                    filename = path.join(directory, member.name)
+                    # Replace files and links rather than writing through them, they may be hardlinks.
+                    if not member.isdir() and path.lexists(filename) and not path.isdir(filename):
+                        os.remove(filename)
+                    archive.extract(member, directory)
+    for name in chmod:
+        os.chmod(path.join(directory, name), manifest[name][2])
+
+    record_tree(tarball, directory)
+    return {'written': len(write), 'deleted': len(delete), 'chmoded': len(chmod)}
+
+
+#####################################################################
+# Content-addressed store of the platform archives                  #
+#####################################################################
+
+# The store holds <sha256>.tar.gz archives with their manifests, and an index.json mapping build numbers to them.
+
+def _index_path(store):
+    return path.join(store, 'index.json')
+
+
+def load_index(store):
+    """
+    Load the index of a store: the artefact of each build, and the size, date and builds of each artefact.
+    """
+    if not path.isfile(_index_path(store)):
+        return {'builds': {}, 'artefacts': {}}
+    with open(_index_path(store)) as f:
+        return json.load(f)
+
+
+def _save_index(store, index):
+    # Write then rename, an interrupted write must not lose the index.
+    tmp = '{}.tmp'.format(_index_path(store))
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.rename(tmp, _index_path(store))
+
+
+def _sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_path(store, sha):
+    return path.join(store, '{}.tar.gz'.format(sha))
+
+
+def add(store, tarball, build, copy=False):
+    """
+    Move an archive into the store under its content hash, with its manifest, and record it as build.
+    An archive already stored is not kept twice.
+    :param copy Copy the archive instead of moving it
+    :return: the content hash of the archive
+    """
+    build = '{}'.format(build)
+    if not path.isdir(store):
+        os.makedirs(store)
+    sha = _sha256(tarball)
+    target = store_path(store, sha)
+    if copy:
+        if not path.isfile(target):
+            shutil.copyfile(tarball, '{}.tmp'.format(target))
+            os.rename('{}.tmp'.format(target), target)
+    elif path.isfile(target):
+        os.remove(tarball)
+    else:
+        os.rename(tarball, target)
+    if path.isfile(manifest_path(tarball)) and not copy:
+        os.rename(manifest_path(tarball), manifest_path(target))
+    if not path.isfile(manifest_path(target)):
+        write_manifest(target)
+
+    index = load_index(store)
+    entry = index['artefacts'].setdefault(sha, {'size': path.getsize(target), 'builds': []})
+    entry['created'] = time.time()
+    if build not in entry['builds']:
+        entry['builds'].append(build)
+    index['builds'][build] = sha
+    _save_index(store, index)
+    return sha
+
+
+# Content hashes can be abbreviated to 7 characters, like git commits.
+HASH_PREFIX = re.compile(r'^[0-9a-f]{7,}$')
+
+
+def find(store, build=None, sha=None):
+    """
+    Find an archive of the store by build number or content hash. Build numbers are never matched against hashes.
+    :param build The build number
+    :param sha The content hash, or a prefix of at least 7 hexadecimal characters of it
+    :return: the path of the archive, the most recently stored one without build nor sha, or None if the store has
+    no such archive
+    """
+    index = load_index(store)
+    if build is not None:
+        sha = index['builds'].get('{}'.format(build))
+    elif sha is not None:
+        if not HASH_PREFIX.match(sha):
+            raise ValueError('{} is not a content hash of at least 7 hexadecimal characters'.format(sha))
+        shas = [candidate for candidate in index['artefacts'] if candidate.startswith(sha)]
+        sha = shas[0] if len(shas) == 1 else None
+    else:
+        shas = sorted(index['artefacts'], key=lambda sha: index['artefacts'][sha]['created'])
+        sha = shas[-1] if shas else None
+    if sha is None or not path.isfile(store_path(store, sha)):
+        return None
+    return store_path(store, sha)
+
+
+def listing(store):
+    """
+    List the archives of the store, most recent first.
+    :return: a list of (content hash, entry) tuples, entries having the size, creation date and builds
+    """
+    entries = load_index(store)['artefacts']
+    return sorted(entries.items(), key=lambda item: item[1]['created'], reverse=True)
+
+
+def prune(store, keep):
+    """
+    Remove the archives of the store, except the keep most recently stored ones.
+    :return: the content hashes of the removed archives
+    """
+    index = load_index(store)
+    removed = [sha for sha, entry in listing(store)[int(keep):]]
+    for sha in removed:
+        for filename in (store_path(store, sha), manifest_path(store_path(store, sha))):
+            if path.isfile(filename):
+                os.remove(filename)
+        del index['artefacts'][sha]
+    index['builds'] = dict((build, sha) for build, sha in index['builds'].items() if sha in index['artefacts'])
+    _save_index(store, index)
+    return removed
@@ -1,6 +1,15 @@
 from __future__ import unicode_literals
-from fabric.api import task, roles, env
+from fabric.api import task, roles, env, execute, settings
 from fabric.colors import green
+from fabric.utils import abort
+from os import path
+from xml.etree import ElementTree
+
+import heapq
+import json
+import os
+import pipes
+import shutil
 
 import helpers as h
 
@@ -20,10 +29,12 @@ def init(rewrite=True):
 
     if not h.fab_exists(role, '{}/tests/behat/behat.yml'.format(workspace)) or rewrite:
         with h.fab_cd(role, '{}/tests/behat'.format(workspace)):
-            h.fab_run(role, 'cp example.behat.yml behat.yml')
-            h.fab_run(role, 'sed -i "s@%DRUPAL_ROOT@{}@g" behat.yml'.format(site_root))
-            h.fab_run(role, 'sed -i "s@%URL@http://{}@g" behat.yml'.format(host))
-            h.fab_run(role, 'echo "127.0.0.1  {}" >> /etc/hosts'.format(host))
+            h.fab_run_batch(role, [
+                'cp example.behat.yml behat.yml',
+                'sed -i "s@%DRUPAL_ROOT@{}@g" behat.yml'.format(site_root),
+                'sed -i "s@%URL@http://{}@g" behat.yml'.format(host),
+                'echo "127.0.0.1  {}" >> /etc/hosts'.format(host),
+            ])
         print green('Behat is now properly configured. The configuration file is {}/tests/behat/behat.yml'.format(workspace))
     else:
       print green('{}/tests/behat/behat.yml is already created.'.format(workspace))
@@ -61,12 +72,138 @@ def run(tags='~@wip&&~@disabled&&~@test'):
     workspace = env.docker_workspace
 
     h.fab_run(role, 'mkdir -p {}/logs/behat'.format(workspace))
+    behat_yml = '{}/tests/behat/behat.yml'.format(workspace)
+    facts = h.fab_facts(role, paths=['/usr/local/bin/behat', '../tests/behat/bin/behat', behat_yml])
     # In the container behat is installed globaly, so check before install it inside the tests directory
-    if not h.fab_exists(role, '/usr/local/bin/behat') or not h.fab_exists(role, '../tests/behat/bin/behat'):
+    if not facts['/usr/local/bin/behat'] or not facts['../tests/behat/bin/behat']:
         install()
     # If the configuration file behat.yml doesn't exist, call behat_init before run the test.
-    if not h.fab_exists(role, '{}/tests/behat/behat.yml'.format(workspace)):
+    if not facts[behat_yml]:
         init()
     with h.fab_cd(role, '{}/tests/behat'.format(workspace)):
         h.fab_run(role, 'behat --format junit --format pretty --tags "{}" --colors'.format(tags))
 
+
+
+#####################################################################
+# Sharded runs across several containers                            #
+#####################################################################
+
+def _features(directory):
+    """
+    List the feature files of the suite, relative to the tests/behat directory.
+    """
+    features = []
+    for dirpath, dirnames, filenames in os.walk(path.join(directory, 'features')):
+        features.extend(path.relpath(path.join(dirpath, name), directory)
+                        for name in filenames if name.endswith('.feature'))
+    return sorted(features)
+
+
+def _durations_file():
+    return path.join(env.builddir, 'behat-durations.json')
+
+
+def _load_durations():
+    if not path.isfile(_durations_file()):
+        return {}
+    with open(_durations_file()) as f:
+        return json.load(f)
+
+
+def shard(features, count, durations):
+    """
+    Split features in count shards of about the same duration, longest features first.
+    Features without a recorded duration count as the average one.
+    :return: a list of count lists of features
+    """
+    known = [durations[feature] for feature in features if feature in durations]
+    default = sum(known) / len(known) if known else 1.0
+    shards = [[] for i in range(count)]
+    loads = [(0.0, i) for i in range(count)]
+    for feature in sorted(features, key=lambda feature: (-durations.get(feature, default), feature)):
+        load, i = heapq.heappop(loads)
+        shards[i].append(feature)
+        heapq.heappush(loads, (load + durations.get(feature, default), i))
+    return shards
+
+
+def _ensure_installed():
+    if not h.fab_facts('docker', paths=['/usr/local/bin/behat'])['/usr/local/bin/behat']:
+        install()
+
+
+def _run_shard(shards, tags):
+    # Run the features of the shard of the current host one at a time, each with its own JUnit output directory
+    # and its duration appended to the durations file of the shard. Return whether every feature passed.
+    role = 'docker'
+    index = shards[env.host_string]['index']
+    out = 'out/shards/{}'.format(index)
+    cmds = ['mkdir -p {}'.format(out)]
+    for i, feature in enumerate(shards[env.host_string]['features']):
+        cmds.append('start=$(date +%s.%N); behat --format pretty --out std --format junit --out {}/{} --tags "{}" '
+                    '--colors {} || status=1; echo {} $start $(date +%s.%N) >> {}/durations'.format(
+                        out, i, tags, pipes.quote(feature), pipes.quote(feature), out))
+    with h.fab_cd(role, '{}/tests/behat'.format(env.docker_workspace)), settings(warn_only=True):
+        result = h.fab_run(role, 'status=0; {}; exit $status'.format('; '.join(cmds)))
+    return not result.failed
+
+
+def _merge_junit(shards_dir, report):
+    """
+    Merge the JUnit reports of the shards into a single report.
+    """
+    merged = ElementTree.Element('testsuites', name='default')
+    for dirpath, dirnames, filenames in sorted(os.walk(shards_dir)):
+        for name in sorted(filenames):
+            if name.endswith('.xml'):
+                root = ElementTree.parse(path.join(dirpath, name)).getroot()
+                merged.extend(root.findall('testsuite') if root.tag == 'testsuites' else [root])
+    ElementTree.ElementTree(merged).write(report, encoding='utf-8', xml_declaration=True)
+    return len(merged)
+
+
+def run_sharded(hosts, tags='~@wip&&~@disabled&&~@test'):
+    """
+    Run the Behat suite split in one shard per container, in parallel. The shards are balanced with the durations of
+    the features recorded in build/behat-durations.json, and their JUnit reports merged in
+    tests/behat/out/behat.junit.xml.
+    :param hosts The containers, each with its own installed site and database
+    :param tags Behat tags filter, applied to every shard
+    """
+    directory = path.join(env.workspace, 'tests', 'behat')
+    features = _features(directory)
+    if not features:
+        abort('No feature found in {}/features.'.format(directory))
+    durations = _load_durations()
+    shards = dict((host, {'index': i, 'features': features})
+                  for i, (host, features) in enumerate(zip(hosts, shard(features, len(hosts), durations))))
+
+    # Behat is installed in the tests directory shared by the containers, check it one container at a time.
+    execute(_ensure_installed, hosts=hosts)
+
+    # The workspace is mounted in every container, the shards write their reports in it.
+    shards_dir = path.join(directory, 'out', 'shards')
+    if path.isdir(shards_dir):
+        shutil.rmtree(shards_dir)
+    for host in hosts:
+        print(green('Shard {} on {}: {} feature(s).'.format(shards[host]['index'], host,
+                                                            len(shards[host]['features']))))
+    with settings(parallel=True, pool_size=len(hosts)):
+        results = execute(_run_shard, shards, tags, hosts=hosts)
+
+    for dirpath, dirnames, filenames in os.walk(shards_dir):
+        if 'durations' in filenames:
+            with open(path.join(dirpath, 'durations')) as f:
+                for line in f:
+                    feature, start, end = line.rsplit(None, 2)
+                    durations[feature] = float(end) - float(start)
+    with open(_durations_file(), 'w') as f:
+        json.dump(durations, f, indent=2, sort_keys=True)
+
+    report = path.join(directory, 'out', 'behat.junit.xml')
+    print(green('{} test suite(s) merged in {}.'.format(_merge_junit(shards_dir, report), report)))
+    # A shard that raised an error returns the exception instead of its result.
+    failed = sorted(shards[host]['index'] for host, passed in results.items() if passed is not True)
+    if failed:
+        abort('Behat tests failed in shard(s) {}.'.format(', '.join('{}'.format(i) for i in failed)))
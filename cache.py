@@ -0,0 +1,373 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from fabric.api import env, local, hide, settings
+from contextlib import closing, contextmanager
+from os import path
+from xml.etree import ElementTree
+
+import errno
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import urllib2
+
+
+#####################################################################
+# Content-addressed caches of build products                        #
+#####################################################################
+
+_include = re.compile(r'^\s*includes\[[^\]]*\]\s*=\s*["\']?([^"\'\s;]+)')
+
+
+def makefile_files(makefile):
+    """
+    List a Drush makefile and, recursively, the local makefiles it includes.
+    """
+    files = [makefile]
+    with open(makefile) as f:
+        for line in f:
+            match = _include.match(line)
+            if match and '://' not in match.group(1):
+                included = path.normpath(path.join(path.dirname(makefile), match.group(1)))
+                if path.isfile(included) and included not in files:
+                    files.extend(name for name in makefile_files(included) if name not in files)
+    return files
+
+
+def hash_makefiles(makefile):
+    """
+    Hash a makefile and the makefiles it includes.
+    """
+    digest = hashlib.sha1()
+    for filename in makefile_files(makefile):
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def git_revision(directory):
+    """
+    Return the HEAD commit of a git checkout followed by its uncommitted changes, or '' if it is not a checkout.
+    """
+    if not path.isdir(path.join(directory, '.git')):
+        return ''
+    with settings(hide('running'), warn_only=True):
+        return local('cd {} && git rev-parse HEAD && git diff HEAD'.format(directory), capture=True)
+
+
+def platform_key(makefile, profile_dir, options):
+    """
+    Compute the cache key of a platform built from makefile, the profile checkout and the drush make options.
+    """
+    digest = hashlib.sha1()
+    digest.update(hash_makefiles(makefile).encode('utf-8'))
+    digest.update(git_revision(profile_dir).encode('utf-8'))
+    digest.update(options.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _platform_dir(key):
+    return path.join(env.builddir, 'platforms', key)
+
+
+# The files and settings of the sites are neither stored nor overwritten, and excluded files are not deleted.
+_MIRROR = "rsync -a --delete --exclude='sites/*/files' --exclude='sites/*/settings.php'"
+
+
+def restore_platform(key, destination):
+    """
+    Mirror the cached platform matching key into destination, hardlinking files if make_cache_hardlink is set.
+    The files of destination that are not in the platform are removed, except the files and settings of the sites.
+    :return: True on a cache hit, False otherwise
+    """
+    source = _platform_dir(key)
+    if not path.isdir(source):
+        return False
+    link = '--link-dest={} '.format(source) if env.make_cache_hardlink else ''
+    local('mkdir -p {} && {} {}{}/ {}/'.format(destination, _MIRROR, link, source, destination))
+    # The modification time tells which platforms were used last.
+    os.utime(source, None)
+    return True
+
+
+def store_platform(key, source):
+    """
+    Store a freshly built platform, without the files and settings of its sites, in the cache and drop the least
+    recently used ones.
+    """
+    target = _platform_dir(key)
+    tmp = '{}.tmp'.format(target)
+    if path.isdir(tmp):
+        shutil.rmtree(tmp)
+    local('mkdir -p {} && {} {}/ {}/'.format(tmp, _MIRROR, source, tmp))
+    if path.isdir(target):
+        shutil.rmtree(target)
+    os.rename(tmp, target)
+
+    root = path.dirname(target)
+    platforms = sorted((path.join(root, name) for name in os.listdir(root) if not name.endswith('.tmp')),
+                       key=path.getmtime, reverse=True)
+    for platform in platforms[int(env.make_cache_size):]:
+        shutil.rmtree(platform)
+
+
+#####################################################################
+# Download cache of Drupal projects, shared by every workspace      #
+#####################################################################
+
+_core = re.compile(r'^\s*core\s*=\s*["\']?([^"\'\s;]+)')
+_project = re.compile(r'^\s*projects\[([^\]]+)\]((?:\[[^\]]*\])*)\s*=\s*["\']?([^"\'\s;]*)')
+
+RELEASE_HISTORY_URL = 'https://updates.drupal.org/release-history/{}/{}'
+
+# Cache entries are named <version>-<md5 of the release tarball>.
+_entry = re.compile(r'^(.+)-[0-9a-f]{32}$')
+
+
+def _entry_version(entry):
+    match = _entry.match(entry)
+    return match.group(1) if match else None
+
+
+def makefile_projects(makefile):
+    """
+    Parse the projects pinned to a version in a makefile and its includes.
+    Projects with a custom download or library are left out, drush make handles them itself. So are the development
+    releases (ie. 7.x-3.x-dev), which are rebuilt from their branch and can not be cached.
+    :return: the core version, and a dict of project names to full versions (ie. 7.x-3.14)
+    """
+    core = None
+    projects = {}
+    custom = set()
+    for filename in reversed(makefile_files(makefile)):
+        with open(filename) as f:
+            for line in f:
+                match = _core.match(line)
+                if match:
+                    core = match.group(1)
+                match = _project.match(line)
+                if not match:
+                    continue
+                name, keys, value = match.groups()
+                if keys in ('', '[version]'):
+                    projects[name] = value
+                elif keys.startswith('[download]') or keys.startswith('[location]'):
+                    custom.add(name)
+    versions = {}
+    for name, version in projects.items():
+        if name in custom or not version or version.endswith('-dev'):
+            continue
+        if name != 'drupal' and core and not version.startswith(core):
+            version = '{}-{}'.format(core, version)
+        versions[name] = version
+    return core, versions
+
+
+def _makedirs(directory):
+    # Builds may create the same directory at the same time.
+    try:
+        os.makedirs(directory)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+
+@contextmanager
+def download_cache_lock(exclusive=False):
+    """
+    Lock the download cache. Builds hold a shared lock while their makefile points to releases of the cache, and
+    the cache is only pruned under an exclusive lock, so a release is never removed while a build copies it.
+    :param exclusive Take the exclusive lock, without waiting for the builds holding the shared lock
+    :return: True if the lock was taken, False if other builds hold it
+    """
+    root = path.expanduser(env.download_cache_dir)
+    _makedirs(root)
+    with open(path.join(root, '.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, (fcntl.LOCK_EX | fcntl.LOCK_NB) if exclusive else fcntl.LOCK_SH)
+        except IOError as error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+        else:
+            yield True
+
+
+def _release(name, core, version):
+    # Look up the tarball URL, checksum and project type of a release on drupal.org.
+    xml = ElementTree.fromstring(urllib2.urlopen(RELEASE_HISTORY_URL.format(name, core), timeout=30).read())
+    project_type = (xml.findtext('type') or 'project_module').replace('project_', '')
+    for release in xml.iter('release'):
+        if release.findtext('version') == version:
+            return release.findtext('download_link'), release.findtext('mdhash'), project_type
+    return None, None, project_type
+
+
+def cached_project(name, core, version):
+    """
+    Return the directory of a project release in the download cache, downloading it on a miss.
+    Releases are immutable: a release already in the cache is used without querying drupal.org. The cache entries
+    are named after the version and the checksum of the release. Development releases are never cached.
+    :return: a tuple (directory, project type, hit), directory being None if the release can not be found
+    """
+    if version.endswith('-dev'):
+        return None, None, False
+    cache_dir = path.expanduser(env.download_cache_dir)
+    root = path.join(cache_dir, name)
+    # 7.x-3.1 must not match 7.x-3.1-rc1.
+    entries = [entry for entry in (os.listdir(root) if path.isdir(root) else [])
+               if _entry_version(entry) == version]
+    if entries:
+        directory = path.join(root, sorted(entries)[-1])
+        os.utime(directory, None)
+        with open(path.join(directory, 'type')) as f:
+            return path.join(directory, name), f.read().strip(), True
+
+    try:
+        url, md5, project_type = _release(name, core, version)
+    except (urllib2.URLError, IOError, ElementTree.ParseError):
+        url = None
+    if not url:
+        return None, None, False
+
+    # The entry is prepared in a temporary directory and renamed at once, so other builds never see it half done.
+    directory = path.join(root, '{}-{}'.format(version, md5))
+    _makedirs(root)
+    tmp = tempfile.mkdtemp(prefix='.download-', dir=cache_dir)
+    try:
+        tarball = path.join(tmp, 'download.tar.gz')
+        with open(tarball, 'wb') as f:
+            shutil.copyfileobj(urllib2.urlopen(url, timeout=60), f)
+        with open(tarball, 'rb') as f:
+            if hashlib.md5(f.read()).hexdigest() != md5:
+                return None, None, False
+        entry = path.join(tmp, 'entry')
+        os.mkdir(entry)
+        with closing(tarfile.open(tarball)) as archive:
+            archive.extractall(entry)
+        os.remove(tarball)
+        # Tarballs contain one top directory, ie. views/ or drupal-7.50/.
+        os.rename(path.join(entry, os.listdir(entry)[0]), path.join(entry, name))
+        with open(path.join(entry, 'type'), 'w') as f:
+            f.write(project_type)
+        try:
+            os.rename(entry, directory)
+        except OSError as error:
+            # Another build stored the release first.
+            if error.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            return path.join(directory, name), project_type, True
+    finally:
+        shutil.rmtree(tmp)
+    return path.join(directory, name), project_type, False
+
+
+def prune_download_cache():
+    """
+    Remove the least recently used releases until the cache fits in download_cache_size megabytes.
+    The cache is left as is while other builds use it, the next build prunes it.
+    """
+    root = path.expanduser(env.download_cache_dir)
+    if not path.isdir(root):
+        return
+    with download_cache_lock(exclusive=True) as locked:
+        if not locked:
+            return
+        entries = []
+        for project in os.listdir(root):
+            # Skip the lock and the downloads in progress.
+            if project.startswith('.'):
+                continue
+            for entry in os.listdir(path.join(root, project)):
+                directory = path.join(root, project, entry)
+                size = sum(path.getsize(path.join(dirpath, name))
+                           for dirpath, dirs, names in os.walk(directory) for name in names)
+                entries.append((path.getmtime(directory), size, directory))
+        total = sum(size for mtime, size, directory in entries)
+        for mtime, size, directory in sorted(entries):
+            if total <= int(env.download_cache_size) * 1024 * 1024:
+                break
+            shutil.rmtree(directory)
+            total -= size
+
+
+def cached_makefile(makefile, destination):
+    """
+    Write a makefile including makefile, that points drush make to the releases of the download cache.
+    Hold download_cache_lock() until drush make has copied the releases.
+    :return: a tuple with the number of cache hits and misses
+    """
+    core, versions = makefile_projects(makefile)
+    hits = misses = 0
+    lines = ['api = 2', 'core = {}'.format(core), 'includes[] = "{}"'.format(path.abspath(makefile))]
+    for name in sorted(versions):
+        directory, project_type, hit = cached_project(name, core, versions[name])
+        if directory is None:
+            continue
+        hits += hit
+        misses += not hit
+        lines.append('projects[{}][type] = "{}"'.format(name, project_type))
+        lines.append('projects[{}][download][type] = "copy"'.format(name))
+        lines.append('projects[{}][download][url] = "{}"'.format(name, directory))
+    with open(destination, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return hits, misses
+
+
+#####################################################################
+# Database snapshots taken after a site installation                #
+#####################################################################
+
+def snapshot_key():
+    """
+    Compute the key of a post-install snapshot from the profile and its code, the makefiles, the hooks and the install
+    options.
+    """
+    digest = hashlib.sha1()
+    makefile_hash = hash_makefiles(env.makefile) if path.isfile(env.makefile) else ''
+    profile_revision = git_revision(path.join(env.builddir, env.site_profile))
+    for value in [env.site_profile, profile_revision, makefile_hash, env.locale, env.site_name, env.site_subdir,
+                  env.site_admin_user, env.site_admin_pass, env.db_dump] + list(env.hook_post_install):
+        digest.update('{}\n'.format(value).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def snapshots():
+    """
+    List the snapshots of build/snapshots, most recent first.
+    :return: a list of (key, modification time, size in bytes) tuples
+    """
+    root = path.join(env.builddir, 'snapshots')
+    entries = []
+    for key in (os.listdir(root) if path.isdir(root) else []):
+        directory = path.join(root, key)
+        if key.endswith('.tmp') or not path.isdir(directory):
+            continue
+        size = sum(path.getsize(path.join(directory, name)) for name in os.listdir(directory))
+        entries.append((key, path.getmtime(directory), size))
+    return sorted(entries, key=lambda entry: entry[1], reverse=True)
+
+
+def remove_snapshot(key):
+    shutil.rmtree(path.join(env.builddir, 'snapshots', key))
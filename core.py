@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 from fabric.api import task, roles, env
 from fabric.colors import red, green
+from os import path
 
 import helpers as h
 
@@ -8,15 +9,20 @@ import helpers as h
 @roles('docker')
 def db_import(filename, role='docker'):
     """Import and restore the specified database dump.
+    The dump is split per table in env.db_import_tmpdir as it is decompressed, and each table is loaded by one of
+    env.db_import_workers concurrent clients as soon as it is split.
 
     $ fab core.db_import:/tmp/db_dump.sql.gz
 
-    :param filename: a full path to a gzipped sql dump.
+    :param filename: a full path to a sql dump, plain, gzipped (.gz) or compressed with zstd (.zst).
     """
 
     if h.fab_exists(role, filename):
         print green('Database dump {} found.'.format(filename))
-        h.fab_run(role, 'zcat {} | mysql -u{} -p{} {}'.format(filename, env.site_db_user, env.site_db_pass, env.site_db_name))
+        script = '/tmp/drupalizer-db-import.sh'
+        h.fab_put(role, path.join(path.dirname(__file__), 'scripts', 'db-import.sh'), script, mode=0755)
+        h.fab_run(role, 'sh {} {} {} {} {} {} "{}"'.format(script, filename, env.db_import_workers, env.site_db_user,
+                                                          env.site_db_pass, env.site_db_name, env.db_import_tmpdir))
         print green('Database dump successfully restored.')
     else:
         print red('Could not find database dump at {}'.format(filename))
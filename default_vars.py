@@ -30,6 +30,53 @@ env.site_subdir = 'default'
 env.site_languages = 'fr'
 
 
+# Build cache
+# Platforms built by drush make are kept in build/platforms and restored when the makefiles and the profile
+# did not change. Set make_cache_hardlink to hardlink the restored files instead of copying them.
+
+env.make_cache = True
+env.make_cache_size = 3
+env.make_cache_hardlink = False
+
+# Drupal projects downloaded by drush make are kept in a download cache shared by every workspace,
+# and the least recently used ones are evicted when it grows over download_cache_size megabytes.
+
+env.download_cache = True
+env.download_cache_dir = '~/.cache/drupalizer/downloads'
+env.download_cache_size = 2048
+
+# Installed sites are snapshotted in build/snapshots, and restored instead of being installed again.
+
+env.install_snapshots = True
+
+# Archives dumped by drush.archive_dump are stored in build/artefacts under their content hash, indexed by build
+# number. The artefact_keep most recent ones are kept.
+
+env.artefact_keep = 10
+
+
+# Git repositories
+# Directories not searched for git repositories by git.check_status, as fnmatch patterns relative to the workspace
+# where '*' also matches '/'.
+
+env.git_discovery_skip = ['build', '*node_modules', '*bower_components', '*sites/*/files']
+
+# Number of repositories checked at the same time by git.check_status.
+
+env.git_check_workers = 8
+
+# Without inotify, the workspace watcher started by git.watch_start checks the repositories every
+# git_watch_interval seconds.
+
+env.git_watch_interval = 10
+
+# The installation profile is cloned with the objects of a bare mirror kept in git_mirror_dir, shared by every
+# workspace ('' to clone without mirror), and with a history of site_profile_depth commits (0 for the full history).
+
+env.git_mirror_dir = '~/.cache/drupalizer/mirrors'
+env.site_profile_depth = 0
+
+
 # PatternLab
 
 # Specify the PatternLab dir is you want the style guide to be generated
@@ -41,12 +88,24 @@ env.patternlab_dir = ''
 
 env.db_dump = False
 
+# Number of tables loaded concurrently when importing a database dump.
+env.db_import_workers = 4
+
+# Directory where the dump is split per table as it is decompressed, the tables are removed once loaded.
+# Empty uses $TMPDIR or /tmp in the container.
+env.db_import_tmpdir = ''
+
 # Docker
 
 env.docker_workspace = '/opt/sfl'
 env.docker_site_root = '{}/src/drupal'.format(env.docker_workspace)
 env.bind_port = 8001
 env.apache_user = 'www-data'
+env.docker_socket = '/var/run/docker.sock'
+
+# Services to wait for after the container starts, and how many seconds to wait for them.
+env.readiness_services = ['ssh', 'apache', 'mysql']
+env.readiness_timeout = 120
 
 # Docker auto-added container IP
 env.container_ip = '172.17.0.0'
@@ -57,7 +116,43 @@ env.container_ip = '172.17.0.0'
 env.hook_post_install = ['drush fra -y', 'drush cc all']
 env.hook_post_update = ['drush fra -y', 'drush cc all']
 
+# Run the hook commands in a single drush process, bootstrapping Drupal once.
+env.hook_batch = True
+
+
+# SSH
+# Commands spawning their own ssh client, like rsync, share one master connection per host.
+
+env.ssh_control_path = '~/.ssh/drupalizer-%r@%h:%p'
+env.ssh_control_persist = 60
+
 
 # Target environments definition
+# An environment can list several web servers in a 'hosts' key instead of a single 'host'.
+# An environment with a 'releases_path' key gets each build in releases_path/releases/<build>, the Drupal root
+# being the releases_path/current symlink. Its 'shared' paths (by default sites/default/files and
+# sites/default/settings.php) are links to releases_path/shared, and 'keep_releases' releases are kept.
 
 env.aliases = {}
+
+# Deployments to several hosts run on deploy_concurrency hosts at a time, by batches of deploy_batch_size hosts
+# (0 for all of them). The deployment stops when the share of failed hosts exceeds deploy_max_failure_rate.
+# With a shared database, the database updates run from the first host only.
+
+env.deploy_concurrency = 4
+env.deploy_batch_size = 0
+env.deploy_max_failure_rate = 0
+env.deploy_shared_database = True
+env.keep_releases = 5
+
+# Compress the platform uploads, and limit their bandwidth in KB/s (0 for no limit).
+
+env.rsync_compress = False
+env.rsync_bwlimit = 0
+
+# Aegir platform verifications and site migrations run aegir_concurrency at a time. The hosting queue is polled
+# every aegir_poll_interval seconds until the tasks complete, for at most aegir_task_timeout seconds.
+
+env.aegir_concurrency = 4
+env.aegir_poll_interval = 5
+env.aegir_task_timeout = 3600
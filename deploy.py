@@ -17,13 +17,19 @@
 #
 
 from __future__ import unicode_literals
-from fabric.api import task, env, local, run
-from fabric.colors import green
+from fabric.api import task, env, local, execute, settings
+from fabric.colors import green, red
 from fabric.utils import abort
 
 import helpers as h
+import aegir
+import artefacts
+import timeline
 import os
-import glob
+import posixpath
+import time
+from datetime import datetime
+from os import path
 
 
 def _set_hosts(environment):
@@ -35,7 +41,52 @@ def _set_hosts(environment):
         abort('Environment {} could not be found in the aliases definition.'.format(environment))
 
     target = env.aliases.get(environment)
-    env.hosts = ['{}@{}'.format(target.get('user'), target.get('host'))]
+    hosts = target.get('hosts') or [target.get('host')]
+    env.hosts = ['{}@{}'.format(target.get('user'), host) for host in hosts]
+
+
+def execute_rolling(func, environment, hosts):
+    """
+    Run a task on hosts by rolling batches of env.deploy_batch_size hosts, env.deploy_concurrency hosts at a time.
+    Abort after a batch when the share of failed hosts exceeds env.deploy_max_failure_rate.
+    :param func The task to run
+    :param environment The environment to deploy the site DEV, STAGE, PROD
+    :param hosts The hosts to run the task on
+    :return: a dict of the seconds the task took on each host
+    """
+    def timed(*args, **kwargs):
+        # warn_only is only meant for collecting the results: a failed command must fail the host.
+        before = dict(h._ssh_stats.get(env.host_string, {}))
+        start = time.time()
+        with settings(warn_only=False):
+            func(*args, **kwargs)
+        seconds = time.time() - start
+        # The task runs in a forked process, send the SSH statistics it gathered back to the parent.
+        after = h._ssh_stats.get(env.host_string, {})
+        ssh = dict((key, value - before.get(key, 0)) for key, value in after.items())
+        return {'seconds': seconds, 'ssh': ssh, 'pid': os.getpid()}
+    timed.__name__ = str(func.name)
+
+    batch_size = int(env.deploy_batch_size) or len(hosts)
+    timings = {}
+    failures = 0
+    for i in range(0, len(hosts), batch_size):
+        batch = hosts[i:i + batch_size]
+        with settings(parallel=True, pool_size=int(env.deploy_concurrency), warn_only=True):
+            results = execute(timed, environment, hosts=batch)
+        for host in batch:
+            result = results.get(host)
+            if isinstance(result, dict):
+                timings[host] = result['seconds']
+                if result['pid'] != os.getpid():
+                    h.ssh_merge(host, result['ssh'])
+                print(green('{} done on {} in {:.2f}s'.format(func.name, host, result['seconds'])))
+            else:
+                failures += 1
+                print(red('{} failed on {}: {}'.format(func.name, host, result)))
+        if failures > float(env.deploy_max_failure_rate) * len(hosts):
+            abort('{} failed on {} of {} hosts, stopping the deployment.'.format(func.name, failures, len(hosts)))
+    return timings
 
 
 def _is_aegir_deployment(target):
@@ -66,31 +117,90 @@ def _target_dir(environment):
     return target.get('root')
 
 
-def _set_site_offline(target, environment):
+def _is_release_deployment(target):
     """
-    Helper function to set the site in maintenance.
-    :param environment
+    Check if the target environment deploys each build in its own release directory.
     """
-    run('drush --yes --root={}  vset site_offline 1'.format(target.get('root')))
-    print(green('The is in maintenance mode on the target environment {}.'.format(environment)))
+    return 'releases_path' in target
 
 
-def _set_site_online(target, environment):
+def _drupal_root(target):
     """
-    Helper function to set the site online.
-    :param environment
+    Return the Drupal root of a Web Server target: the current release, or the root directory.
+    """
+    if _is_release_deployment(target):
+        return posixpath.join(target.get('releases_path'), 'current')
+    return target.get('root')
+
+
+def _release_dir(target):
+    """
+    Return the release directory of the build to deploy, named after the build number or the current time.
     """
-    run('drush --yes --root={} vset site_offline 0'.format(target.get('root')))
-    print(green('The site is online on the target environment {}.'.format(environment)))
+    name = env.get('build_number') or datetime.now().strftime('%Y%m%d%H%M%S')
+    return posixpath.join(target.get('releases_path'), 'releases', str(name))
 
 
-def _update_site_database(target, environment):
+def _link_shared_paths(target, release):
     """
-    Helper function to update site database.
+    Replace the paths specific to the site, like its files and settings, by links to the shared directory.
+    The first deployment moves them to the shared directory.
+    :param release The release directory
+    """
+    shared = posixpath.join(target.get('releases_path'), 'shared')
+    cmds = []
+    for shared_path in target.get('shared', ['sites/default/files', 'sites/default/settings.php']):
+        source = posixpath.join(shared, shared_path)
+        destination = posixpath.join(release, shared_path)
+        cmds.append('mkdir -p {}'.format(posixpath.dirname(source)))
+        cmds.append('if [ ! -e {} ] && [ -e {} ]; then mv {} {}; fi'.format(source, destination, destination, source))
+        cmds.append('rm -rf {} && ln -s {} {}'.format(destination, source, destination))
+    h.fab_run_batch('deploy', cmds)
+
+
+def _switch_release(target, release, offline=False):
+    """
+    Point the current symlink to a release directory, atomically.
+    :param release The release directory
+    :param offline Set the site in maintenance first, in the same round trip
+    """
+    current = posixpath.join(target.get('releases_path'), 'current')
+    cmds = ['ln -sfn {} {}.tmp && mv -T {}.tmp {}'.format(release, current, current, current)]
+    if offline:
+        cmds.insert(0, 'drush --yes --root={} vset site_offline 1'.format(current))
+        timeline.mark('offline')
+    with timeline.phase('switch'):
+        h.fab_run_batch('deploy', cmds)
+    print(green('The release {} is now the current one.'.format(posixpath.basename(release))))
+
+
+def _list_releases(target):
+    """
+    List the releases of a target, most recent first.
+    """
+    releases = posixpath.join(target.get('releases_path'), 'releases')
+    return h.fab_run('deploy', 'ls -1t {}'.format(releases), capture=True).split()
+
+
+def _prune_releases(target):
+    """
+    Remove the oldest releases, keeping keep_releases of them.
+    """
+    releases = posixpath.join(target.get('releases_path'), 'releases')
+    keep = int(target.get('keep_releases', env.keep_releases))
+    old = _list_releases(target)[keep:]
+    if old:
+        h.fab_run('deploy', 'cd {} && rm -rf {}'.format(releases, ' '.join(old)))
+
+
+def _set_site_offline(target, environment):
+    """
+    Helper function to set the site in maintenance.
     :param environment
     """
-    run('drush --yes --root={} updatedb'.format(target.get('root')))
-    print(green('The target environment {} is up-to-date.'.format(environment)))
+    h.fab_run('deploy', 'drush --yes --root={}  vset site_offline 1'.format(_drupal_root(target)))
+    timeline.mark('offline')
+    print(green('The is in maintenance mode on the target environment {}.'.format(environment)))
 
 
 def _clear_site_cache(target, environment):
@@ -99,51 +209,72 @@ def _clear_site_cache(target, environment):
     :param environment
     """
 
-    run('drush --yes --root={} cache-clear all'.format(target.get('root')))
+    h.fab_run('deploy', 'drush --yes --root={} cache-clear all'.format(_drupal_root(target)))
     print(green('The cache have been cleared on the target environment {}.'.format(environment)))
 
 
-def _get_archive_from_dir(directory):
+def _rsync_platform(target, target_directory, link_dest=None):
     """
-    List tarball archives in a directory.
-    :param directory The directory used to untar the artefact.
+    Helper function to rsync platform to server.
+    :param link_dest A previous platform on the server: unchanged files are hardlinked from it instead of being sent.
+    :return: a dict with the number of files and bytes sent
     """
-    files = glob.glob1(directory, '*.tar.gz')
-    if len(files) == 0:
-        abort('No tarball found in {}'.format(directory))
-    if len(files) > 1:
-        abort('More than one tarball has been found in {}. Can not decide which one to deploy.'.format(directory))
-    return files[0]
+    opts = '-a --stats'
+    if link_dest:
+        opts += ' --link-dest={}'.format(link_dest)
+    if env.rsync_compress:
+        opts += ' -z'
+    if int(env.rsync_bwlimit):
+        opts += ' --bwlimit={}'.format(env.rsync_bwlimit)
+    with timeline.phase('rsync') as stats:
+        output = local('rsync {} -e "ssh {}" src/drupal/ {}@{}:{}'.format(opts, h.ssh_options(), env.user, env.host,
+                                                                          target_directory), capture=True)
+        for line in output.splitlines():
+            name, _, value = line.partition(': ')
+            if name in ('Number of regular files transferred', 'Total bytes sent'):
+                stats['files' if name.startswith('Number') else 'bytes'] = int(value.split()[0].replace(',', ''))
+    print(green('{} file(s) and {} byte(s) sent to {}:{}.'.format(stats.get('files', 0), stats.get('bytes', 0),
+                                                                   env.host, target_directory)))
+    return stats
 
 
-def _rsync_platform(target, target_directory):
+def _previous_platform(target, environment, target_directory):
     """
-    Helper function to rsync platform to server.
+    Return the most recent Aegir platform of the environment other than the one to deploy, or None.
     """
-    local('rsync -a src/drupal/ {}@{}:{}'.format(target.get('user'), target.get('host'), target_directory))
+    pattern = target.get('root') + target.get('aegir_platform').format(name=env.project_name, env=environment,
+                                                                      build='*')
+    previous = h.fab_run('deploy', 'ls -1dt {} 2> /dev/null | grep -v -x {} | head -n 1; true'.format(
+        pattern, target_directory), capture=True).strip()
+    return previous or None
+
+
+def _current_release(target):
+    """
+    Return the directory of the current release, or None before the first release.
+    """
+    current = h.fab_run('deploy', 'readlink -e {}; true'.format(_drupal_root(target)), capture=True).strip()
+    return current or None
 
 
 def _aegir_provision_platform(platform, aegir_path, aegir_destsrv):
     """
-    Provision the platform on Aegir
+    Provision the platform on Aegir, waiting for its verification.
     :param platform The platform name
     :param aegir_path The path to the home of aegir, usually in /var/aegir
     :param aegir_destsrv The destination webserver for the platform.
     """
-    run('drush --root="{}/platforms/{}" provision-save "@platform_{}" --context_type="platform" --web_server=@{}'
-        .format(aegir_path, platform, platform, aegir_destsrv))
-    run('drush @hostmaster hosting-import platform_{}'.format(platform))
-    run('drush @hostmaster hosting-dispatch')
+    aegir.provision_platforms('deploy', [platform], aegir_path, aegir_destsrv)
 
 
 def _aegir_migrate_sites(target, environment, platform):
     """
-    Helper funtion to migrage sites in aegir after a deployment.
+    Helper funtion to migrate the sites of the previous platforms of the environment in aegir after a deployment.
     :param environment
-    :param platform The patern name of the platform in wich the sites will be migrated on
+    :param platform The name of the platform in wich the sites will be migrated on
     """
-    aegir_path = target.get('aegir_path')
-    run('{}/migrate-sites {} {}'.format(aegir_path, environment, platform))
+    pattern = target.get('aegir_platform').format(name=env.project_name, env=environment, build='*')
+    return aegir.migrate_sites('deploy', pattern, platform)
 
 
 def _aegir_remove_platform_without_sites(target, environment, platform):
@@ -153,28 +284,59 @@ def _aegir_remove_platform_without_sites(target, environment, platform):
     :param platform The patern name of the platform in wich the sites will be migrated on
     """
     aegir_path = target.get('aegir_path')
-    run('{}/remove-platforms {} {}'.format(aegir_path, environment, platform))
+    h.fab_run('deploy', '{}/remove-platforms {} {}'.format(aegir_path, environment, platform))
 
 
 @task
-def provision(environment, role='local'):
+def provision(environment, role='local', artefact=None):
     """
     Provision a Jenkins deployment.
-    This task loads the target environment and extract the archive to deploy.
+    This task loads the target environment and extract the archive to deploy from the artefact store.
     :param environment The environment to deploy the site DEV, STAGE, PROD
     :param role Tha fabric role to run the task.
+    :param artefact The build number of the artefact, its content hash abbreviated to at least 7 characters, or the
+    path of an archive to add to the store. Default to the artefact of build_number, or the most recent one when
+    build_number is not set.
     """
     _set_hosts(environment)
 
-    artefact = _get_archive_from_dir(env.builddir)
-
-    with h.fab_cd(role, '{}/src'.format(env.workspace)):
-
-        # Clear the currently installed platform
-        if h.fab_exists(role, env.site_root):
-            h.fab_run(role, 'rm -rf {}'.format(env.site_root))
-        # Extract the platform to deploy
-        h.fab_run(role, 'tar -xzf {}/{}'.format(env.builddir, artefact))
+    store = path.join(env.builddir, 'artefacts')
+    if artefact and path.isfile(artefact):
+        build = env.get('build_number') or datetime.now().strftime('%Y%m%d_%H%M%S')
+        artefact = artefacts.add(store, artefact, build, copy=True)
+        print(green('Archive added to the artefact store for build {}.'.format(build)))
+
+    # Only fall back to the most recent artefact when no artefact nor build number was given.
+    if artefact:
+        tarball = artefacts.find(store, build=artefact)
+        if tarball is None and artefacts.HASH_PREFIX.match(artefact):
+            tarball = artefacts.find(store, sha=artefact)
+    elif env.get('build_number'):
+        artefact = env.build_number
+        tarball = artefacts.find(store, build=artefact)
+    else:
+        tarball = artefacts.find(store)
+    if tarball is None:
+        abort('No artefact {}found in {}.'.format('{} '.format(artefact) if artefact else '', store))
+    artefact = path.basename(tarball)
+    src = '{}/src'.format(env.workspace)
+
+    with h.fab_cd(role, src), timeline.phase('extract') as data:
+
+        # Only update the files that changed since the previous extraction, when the manifests allow it
+        changes = artefacts.extract_incremental(tarball, src) if role == 'local' else None
+        if changes is not None:
+            data.update(changes)
+            print(green('Platform updated incrementally: {written} written, {deleted} deleted and '
+                        '{chmoded} chmoded path(s).'.format(**changes)))
+        else:
+            # Clear the currently installed platform
+            if h.fab_exists(role, env.site_root):
+                h.fab_run(role, 'rm -rf {}'.format(env.site_root))
+            # Extract the platform to deploy
+            h.fab_run(role, 'tar -xzf {}'.format(tarball))
+            if role == 'local':
+                artefacts.record_tree(tarball, src)
 
         # Fast-check if the archive looks like a Drupal installation
         if not h.fab_exists(role, '{}/src/drupal'.format(env.workspace)):
@@ -198,9 +360,21 @@ def push(environment):
 
     if _is_aegir_deployment(target):
         # Push platform to Aegir Server
-        _rsync_platform(target, target_directory)
+        _rsync_platform(target, target_directory, _previous_platform(target, environment, target_directory))
         platform = _aegir_platform_name(target, environment)
-        _aegir_provision_platform(platform, target.get('aegir_path'), target.get('aegir_destsrv'))
+        with timeline.phase('aegir-provision'):
+            _aegir_provision_platform(platform, target.get('aegir_path'), target.get('aegir_destsrv'))
+    elif _is_release_deployment(target):
+        # Upload the release while the site is still online, then switch to it during the maintenance.
+        # The first release has no current site to set offline.
+        release = _release_dir(target)
+        current = _current_release(target)
+        h.fab_run('deploy', 'mkdir -p {}'.format(posixpath.dirname(release)))
+        _rsync_platform(target, release, current)
+        h.fab_run('deploy', 'touch {}'.format(release))
+        _link_shared_paths(target, release)
+        _switch_release(target, release, offline=current is not None)
+        _prune_releases(target)
     else:
         # Push platform to Web Server
         _set_site_offline(target, environment)
@@ -212,18 +386,52 @@ def migrate(environment):
     """
     Migrate the Drupal database on the target environment.
     :param environment: The target environment. It must match a valid Drush alias.
+    :return: on a Web Server, the command, status and seconds of each migration step
     """
     target = env.aliases.get(environment)
     if _is_aegir_deployment(target):
         # Deploy to Aegir server.
         platform = _aegir_platform_name(target, environment)
         if env.get('migrate', "false") == "true":
-            _aegir_migrate_sites(target, environment, platform)
+            with timeline.phase('aegir-migrate'):
+                _aegir_migrate_sites(target, environment, platform)
 
         if env.get('remove_platforms', "false") == "true":
             _aegir_remove_platform_without_sites(target, environment, platform)
     else:
-        # Deploy to a Web Server
-        _update_site_database(target, environment)
-        _clear_site_cache(target, environment)
-        _set_site_online(target, environment)
+        # Deploy to a Web Server: the database is updated by a drush process of its own, then the cache is cleared
+        # and the site set online with a single Drupal bootstrap
+        start = time.time()
+        results = h.drush_batch('deploy', ['drush updatedb --yes', 'drush cache-clear all',
+                                           'drush vset site_offline 0 --yes'], _drupal_root(target))
+        for name, result in zip(['updatedb', 'cache-clear', 'set-online'], results):
+            print(green('{:8.2f}s  {}'.format(result['seconds'], result['command'])))
+            timeline.record(name, start, start + result['seconds'])
+            start += result['seconds']
+        timeline.mark('online')
+        print(green('The site is up-to-date and online on the target environment {}.'.format(environment)))
+        return results
+
+
+@task
+def rollback(environment):
+    """
+    Switch a release deployment back to the previous release. The database is left as is.
+    :param environment: The target environment. It must match a valid Drush alias.
+    """
+    _set_hosts(environment)
+    execute(_rollback, environment, hosts=env.hosts)
+
+
+def _rollback(environment):
+    target = env.aliases.get(environment)
+    if not _is_release_deployment(target):
+        abort('The target environment {} does not deploy releases.'.format(environment))
+
+    current = posixpath.basename(h.fab_run('deploy', 'readlink {}'.format(_drupal_root(target)), capture=True))
+    releases = _list_releases(target)
+    if current not in releases or releases.index(current) + 1 >= len(releases):
+        abort('There is no release older than {} to roll back to.'.format(current))
+    previous = releases[releases.index(current) + 1]
+    _switch_release(target, posixpath.join(target.get('releases_path'), 'releases', previous))
+    _clear_site_cache(target, environment)
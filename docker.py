@@ -1,20 +1,97 @@
 from __future__ import unicode_literals
-from fabric.api import task, roles, env, local, run
+from fabric.api import task, roles, env, execute, settings
 from fabric.colors import red, green
+from fabric.utils import abort
+from contextlib import contextmanager
+from os import path
 
+import docker_api
 import helpers as h
+import drush
+import behat
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import time
 
 ###########################################################
 # Helper functions to manage docker images and containers #
 ###########################################################
 
+# Snapshot of the docker daemon state, shared by every docker_* helper below.
+# It is fetched once and dropped after each command that changes containers or images.
+_state = None
+
+
+def docker_state():
+    """
+    Return the cached snapshot of containers and images, fetching it on first use.
+    Containers are indexed by name with their running flag, IP address and health status.
+    """
+    global _state
+    if _state is None:
+        _state = _fetch_state()
+    return _state
+
+
+def docker_invalidate():
+    # Forget the cached snapshot, the next docker_* call will fetch a fresh one.
+    global _state
+    _state = None
+
+
+def _health(status):
+    # The container list only tells the health in its Status text, ie. 'Up 5 seconds (health: starting)' or
+    # 'Up 3 minutes (healthy)'. Return it like the Health.Status of docker inspect: starting, healthy or unhealthy.
+    if not status.endswith(')'):
+        return ''
+    health = status[status.rfind('(') + 1:-1]
+    if health.startswith('health: '):
+        health = health[len('health: '):]
+    return health if health in ('starting', 'healthy', 'unhealthy') else ''
+
+
+def _fetch_state():
+    api = docker_api.client()
+    containers = {}
+    for info in api.containers(all=True):
+        networks = (info.get('NetworkSettings') or {}).get('Networks') or {}
+        network = networks.get('bridge') or next(iter(networks.values()), {})
+        status = info.get('Status', '')
+        containers[info['Names'][0].lstrip('/')] = {
+            'running': info.get('State') == 'running' or status.startswith('Up'),
+            'ip': network.get('IPAddress', ''),
+            'health': _health(status),
+        }
+    images = []
+    for info in api.images():
+        for tag in info.get('RepoTags') or ['<none>:<none>']:
+            images.append(tag.rsplit(':', 1)[0])
+    return {'containers': containers, 'images': images}
+
+
+def docker_local(cmd, role='local'):
+    # Run a docker command that changes the daemon state, then drop the cached snapshot.
+    try:
+        return h.fab_run(role, cmd)
+    finally:
+        docker_invalidate()
+
+
 def docker_ps(running_only=False):
-    args = '' if running_only else '-a'
-    result = local('docker ps --no-trunc  %s' % args, capture=True)
-    lines = result.stdout.splitlines()
-    # container name is supposed to be the last column
-    assert lines[0].strip().endswith('NAMES')
-    return [line.strip().split(' ')[-1] for line in lines[1:]]
+    containers = docker_state()['containers']
+    return [name for name, info in containers.items() if info['running'] or not running_only]
+
+
+def docker_ip(containername):
+    # Return the IP address of containername, or None if the container does not exist.
+    info = docker_state()['containers'].get(containername)
+    return info['ip'] if info else None
 
 
 def docker_tryrun(imgname, containername=None, opts='', mounts=None, cmd='', restart=True):
@@ -28,7 +105,7 @@ def docker_tryrun(imgname, containername=None, opts='', mounts=None, cmd='', res
     if containername and containername in docker_ps(running_only=False):
         if restart:
             print green("%s already exists and is stopped. Restarting!" % containername)
-            local('docker restart %s' % containername)
+            docker_local('docker restart %s' % containername)
             return True
         else:
             print red("There's a dangling container %s! That's not supposed to happen. Aborting" % containername)
@@ -44,7 +121,7 @@ def docker_tryrun(imgname, containername=None, opts='', mounts=None, cmd='', res
         containername_opt = '--name %s' % containername
     else:
         containername_opt = ''
-    local('docker run %s %s %s %s' % (opts, containername_opt, imgname, cmd))
+    docker_local('docker run %s %s %s %s' % (opts, containername_opt, imgname, cmd))
     return True
 
 
@@ -53,7 +130,7 @@ def docker_ensureruns(containername):
     # doesn't exist, spew an error.
     if containername not in docker_ps(running_only=True):
         if containername in docker_ps(running_only=False):
-            local('docker restart %s' % containername)
+            docker_local('docker restart %s' % containername)
             return True
         else:
             return False
@@ -70,7 +147,7 @@ def docker_ensure_data_container(containername, volume_paths=None, base_image='b
             volume_args = ' '.join('-v %s' % volpath for volpath in volume_paths)
         else:
             volume_args = ''
-        local('docker create %s --name %s %s' % (volume_args, containername, base_image))
+        docker_local('docker create %s --name %s %s' % (volume_args, containername, base_image))
         return True
     return False
 
@@ -84,11 +161,144 @@ def docker_isrunning(containername):
 
 
 def docker_images():
-    result = local('docker images', capture=True)
-    lines = result.stdout.splitlines()
-    # image name is supposed to be the first column
-    assert lines[0].strip().startswith('REPOSITORY')
-    return [line.strip().split(' ')[0] for line in lines]
+    return list(docker_state()['images'])
+
+
+# Label storing the hash of the build context the image was built from.
+CONTEXT_HASH_LABEL = 'drupalizer.context-hash'
+
+
+def docker_context_hash(directory):
+    # Hash the Dockerfile and every file under conf/, which includes the copied public SSH key.
+    digest = hashlib.sha1()
+    files = [path.join(directory, 'Dockerfile')]
+    for root, dirs, names in os.walk(path.join(directory, 'conf')):
+        dirs.sort()
+        files.extend(path.join(root, name) for name in sorted(names))
+    for filename in files:
+        if path.isfile(filename):
+            digest.update(path.relpath(filename, directory).encode('utf-8'))
+            with open(filename, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+# BuildKit prints '#5 [2/4] RUN make' when a step starts, then '#5 DONE 12.3s' or '#5 CACHED' when it ends.
+_buildkit_start = re.compile(r'^#(\d+) (\[.+)$')
+_buildkit_end = re.compile(r'^#(\d+) (?:DONE (\d+(?:\.\d+)?)s|CACHED)$')
+
+
+def docker_build_steps(lines):
+    """
+    Time the steps of a docker build from its output, given as (timestamp, line) tuples.
+    The legacy builder prints 'Step N/M : ...' when a step starts, so a step lasts until the next one starts.
+    BuildKit tells the duration of each step itself.
+    :return: a list of (step, seconds) tuples, seconds being None when the legacy output was not timestamped
+    """
+    steps = []
+    buildkit = {}
+    legacy = None
+    end = None
+    for timestamp, line in lines:
+        end = timestamp
+        if line.startswith('Step '):
+            if legacy is not None and timestamp is not None:
+                legacy[1] = timestamp - legacy[2]
+            legacy = [line, None, timestamp]
+            steps.append(legacy)
+            continue
+        match = _buildkit_start.match(line)
+        if match and match.group(1) not in buildkit:
+            buildkit[match.group(1)] = [match.group(2), None, timestamp]
+            steps.append(buildkit[match.group(1)])
+            continue
+        match = _buildkit_end.match(line)
+        if match and match.group(1) in buildkit:
+            buildkit[match.group(1)][1] = float(match.group(2) or 0)
+    if legacy is not None and end is not None:
+        legacy[1] = end - legacy[2]
+    return [(label, seconds) for label, seconds, start in steps]
+
+
+def docker_build(image, context_hash, directory, role='local'):
+    # Build image with the layer cache, label it with its context hash and report the time spent per build step.
+    cmd = ['docker', 'build', '--label', '{}={}'.format(CONTEXT_HASH_LABEL, context_hash), '-t', image, '.']
+    if role == 'local':
+        lines = []
+        try:
+            process = subprocess.Popen(cmd, cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in iter(process.stdout.readline, b''):
+                line = line.decode('utf-8', 'replace').rstrip()
+                print(line)
+                lines.append((time.time(), line))
+            process.wait()
+        finally:
+            docker_invalidate()
+        returncode = process.returncode
+    else:
+        # Fabric prints the output of remote commands as it goes, it is parsed once the build ended.
+        with h.fab_cd(role, directory), settings(warn_only=True):
+            output = docker_local(' '.join(cmd), role)
+        lines = [(None, line.rstrip()) for line in output.splitlines()]
+        returncode = output.return_code
+    for label, seconds in docker_build_steps(lines):
+        if seconds is not None:
+            print(green('{:8.2f}s  {}'.format(seconds, label)))
+    if returncode != 0:
+        abort('Docker build of {} failed with exit code {}'.format(image, returncode))
+
+
+def _probe_tcp(ip, port, send=None, expect=None):
+    # Check that something answers on ip:port, optionally checking the beginning of its answer.
+    if not ip:
+        return False
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(2)
+    try:
+        sock.connect((ip, port))
+        if send:
+            sock.sendall(send)
+        return expect is None or sock.recv(len(expect)) == expect
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def _probe_mysql(containername):
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(['docker', 'exec', containername, 'mysqladmin', 'ping', '--silent'],
+                               stdout=devnull, stderr=devnull) == 0
+
+
+# Readiness probes of the services running in the container, given its name and IP address.
+READINESS_PROBES = {
+    'ssh': lambda name, ip: _probe_tcp(ip, 22, expect=b'SSH-'),
+    'apache': lambda name, ip: _probe_tcp(ip, 80, send=b'HEAD / HTTP/1.0\r\n\r\n', expect=b'HTTP/'),
+    'mysql': lambda name, ip: _probe_mysql(name),
+}
+
+
+def docker_wait_ready(containername, services, timeout):
+    """
+    Poll each service of a container with an exponential backoff until it answers.
+    Abort if a service is still not ready after timeout seconds.
+    :return: a dict of the seconds each service took to become ready
+    """
+    start = time.time()
+    deadline = start + timeout
+    ready = {}
+    for service in services:
+        delay = 0.1
+        while not READINESS_PROBES[service](containername, docker_ip(containername)):
+            if time.time() + delay > deadline:
+                abort('Service {} in {} was not ready after {} seconds'.format(service, containername, timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+            # The IP address is only known once the container is up.
+            docker_invalidate()
+        ready[service] = time.time() - start
+    return ready
 
 
 @task
@@ -111,17 +321,24 @@ def connect(role='local'):
 def image_create(role='local'):
 
     """
-    Create docker images
+    Create docker images, or rebuild them when the Dockerfile or the conf/ directory changed.
     :param role Default 'role' where to run the task
     """
 
+    image = '{}/drupal'.format(env.project_name)
+
     with h.fab_cd(role, env.workspace):
-        if '{}/drupal'.format(env.project_name) in docker_images():
-            print(red('Docker image {}/drupal was found, you has already build this image'.format(env.project_name)))
-        else:
-            h.copy_public_ssh_keys(role)
-            h.fab_run(role, 'docker build -t {}/drupal .'.format(env.project_name))
-            print(green('Docker image {}/drupal was build successful'.format(env.project_name)))
+        h.copy_public_ssh_keys(role)
+        context_hash = docker_context_hash(env.workspace)
+        info = docker_api.client().inspect_image(image)
+        if info:
+            labels = info.get('Config', {}).get('Labels') or {}
+            if labels.get(CONTEXT_HASH_LABEL) == context_hash:
+                print(green('Docker image {} is up to date with its build context'.format(image)))
+                return
+            print(green('Docker build context changed since {} was built, rebuilding it'.format(image)))
+        docker_build(image, context_hash, env.workspace, role)
+        print(green('Docker image {} was build successful'.format(image)))
 
 
 @task
@@ -138,8 +355,7 @@ def container_start(role='local'):
                              '-d -p {}:80'.format(env.bind_port),
                              mounts=[(env.workspace, env.docker_workspace, True)]):
                 # If container was successful build, get the IP address and show it to the user.
-                env.container_ip = h.fab_run(role, 'docker inspect -f "{{{{.NetworkSettings.IPAddress}}}}" '
-                                             '{}_container'.format(env.project_name), capture=True)
+                env.container_ip = docker_ip('{}_container'.format(env.project_name))
                 if env.get('always_use_pty', True):
                     h.fab_update_hosts(env.container_ip, env.site_hostname)
 
@@ -155,6 +371,21 @@ def container_start(role='local'):
                       'image'.format(env.project_name, env.project_name, env.project_name)))
 
 
+@task
+@roles('local')
+def container_ready(role='local'):
+    """
+    Wait until the services of the docker container (SSH, Apache and MySQL by default) accept connections.
+    :param role Default 'role' where to run the task
+    """
+    containername = '{}_container'.format(env.project_name)
+    if not docker_isrunning(containername):
+        abort('Docker container {} is not running.'.format(containername))
+    ready = docker_wait_ready(containername, env.readiness_services, env.readiness_timeout)
+    for service in env.readiness_services:
+        print(green('{} is ready after {:.2f}s'.format(service, ready[service])))
+
+
 @task
 @roles('local')
 def container_stop(role='local'):
@@ -166,7 +397,7 @@ def container_stop(role='local'):
         if '{}_container'.format(env.project_name) in docker_ps():
             if env.get('always_use_pty', True):
                 h.fab_remove_from_hosts(env.site_hostname)
-            h.fab_run(role, 'docker stop {}_container'.format(env.project_name))
+            docker_local('docker stop {}_container'.format(env.project_name), role)
             print(green('Docker container {}_container was successful stopped'.format(env.project_name)))
         else:
             print(red('Docker container {}_container was not running or paused'.format(env.project_name)))
@@ -185,7 +416,7 @@ def container_remove(role='local'):
             if env.get('always_use_pty', True):
                 h.fab_remove_from_hosts(env.site_hostname)
             
-            h.fab_run(role, 'docker rm -f {}_container'.format(env.project_name))
+            docker_local('docker rm -f {}_container'.format(env.project_name), role)
             print(green('Docker container {}_container was successful removed'.format(env.project_name)))
         else:
             print(red('Docker container {}_container was already removed'.format(env.project_name)))
@@ -204,15 +435,138 @@ def image_remove(role='local'):
                       'you should stopped it after remove the image {}/drupal'.format(env.project_name,
                                                                                       env.project_name)))
         if '{}/drupal'.format(env.project_name) in docker_images():
-            h.fab_run(role, 'docker rmi -f {}/drupal'.format(env.project_name))
+            docker_local('docker rmi -f {}/drupal'.format(env.project_name), role)
             # Remove dangling docker images to free space.
             if '<none>' in docker_images():
-                h.fab_run(role, 'docker images --filter="dangling=true" -q | xargs docker rmi -f')
+                docker_local('docker images --filter="dangling=true" -q | xargs docker rmi -f', role)
             print(green('Docker image {}/drupal was successful removed'.format(env.project_name)))
         else:
             print(red('Docker image {}/drupal was not found'.format(env.project_name)))
 
 
+###########################################################
+# Pool of pre-initialised containers for tests and CI     #
+###########################################################
+
+@contextmanager
+def _pool_state(create=False):
+    # Load the pool description under an exclusive lock, and save it back when the block exits.
+    # Without a pool, None is given without locking nor querying docker, unless create is set.
+    pool_file = path.join(env.builddir, 'docker_pool.json')
+    if not create and not path.exists(pool_file):
+        yield None
+        return
+    with open('{}.lock'.format(pool_file), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        pool = {}
+        if path.exists(pool_file):
+            with open(pool_file) as f:
+                pool = json.load(f)
+        # Forget the containers removed behind our back.
+        for name in set(pool) - set(docker_ps()):
+            del pool[name]
+        yield pool
+        with open(pool_file, 'w') as f:
+            json.dump(pool, f, indent=2)
+
+
+def docker_pool_lease():
+    """
+    Lease a free container of the pool.
+    :return: a dict with the name, ip and port of the leased container, or None if the pool has no free container.
+    """
+    with _pool_state() as pool:
+        for name in sorted(pool or {}):
+            if not pool[name]['leased'] and docker_isrunning(name):
+                pool[name]['leased'] = True
+                return dict(pool[name], name=name)
+    return None
+
+
+def docker_pool_release(name):
+    with _pool_state() as pool:
+        if pool and name in pool:
+            pool[name]['leased'] = False
+
+
+def _pool_site_mount(name):
+    # The containers share the workspace but each one has its own site directory, with its settings.php and files.
+    # It starts as a copy of the site directory of the workspace, without its settings.php and files.
+    sites = path.join(env.builddir, 'pool', name, 'sites')
+    site_dir = path.join(sites, env.site_subdir)
+    if not path.isdir(site_dir):
+        source = path.join(env.site_root, 'sites', env.site_subdir)
+        if path.isdir(source):
+            shutil.copytree(source, site_dir, symlinks=True, ignore=shutil.ignore_patterns('files', 'settings.php'))
+        else:
+            os.makedirs(site_dir)
+    return site_dir, '{}/sites/{}'.format(env.docker_site_root, env.site_subdir), True
+
+
+@task
+@roles('local')
+def pool_start(size=2, role='local'):
+    """
+    Start a pool of containers with the site installed, to be leased by "fab init" and "fab test".
+    The platform must have been built first, with "fab init" or "fab drush.make".
+    :param size Number of containers in the pool
+    :param role Default 'role' where to run the task
+    """
+    image = '{}/drupal'.format(env.project_name)
+    if image not in docker_images():
+        abort('Docker image {} not found, run "fab docker.image_create" first.'.format(image))
+
+    for i in range(1, int(size) + 1):
+        name = '{}_pool_{}'.format(env.project_name, i)
+        port = int(env.bind_port) + i
+        with _pool_state(create=True) as pool:
+            registered = name in pool and docker_isrunning(name)
+        if registered:
+            print(green('Docker container {} is already in the pool'.format(name)))
+            continue
+        # A container already running but not in the pool, like after an interrupted pool_start, is installed again.
+        with h.fab_cd(role, env.workspace):
+            docker_tryrun(image, name, '-d -p {}:80'.format(port),
+                          mounts=[(env.workspace, env.docker_workspace, True), _pool_site_mount(name)])
+        docker_wait_ready(name, env.readiness_services, env.readiness_timeout)
+        ip = docker_ip(name)
+        execute(drush.site_install, host='root@{}'.format(ip))
+        execute(behat.init, host='root@{}'.format(ip))
+        with _pool_state() as pool:
+            pool[name] = {'ip': ip, 'port': port, 'leased': False}
+        print(green('Docker container {} is ready in the pool at http://localhost:{}'.format(name, port)))
+
+
+@task
+@roles('local')
+def pool_release(name):
+    """
+    Give a leased container back to the pool.
+    :param name Name of the leased container
+    """
+    docker_pool_release(name)
+    print(green('Docker container {} is back in the pool'.format(name)))
+
+
+@task
+@roles('local')
+def pool_stop(role='local'):
+    """
+    Remove every container of the pool.
+    :param role Default 'role' where to run the task
+    """
+    with _pool_state() as pool:
+        for name in sorted(pool or {}):
+            # The files of the site are owned by the web server user, they are removed from the container.
+            with settings(warn_only=True):
+                docker_local('docker exec {} rm -rf {}/sites/{}/files'.format(name, env.docker_site_root,
+                                                                               env.site_subdir), role)
+            docker_local('docker rm -f {}'.format(name), role)
+            shutil.rmtree(path.join(env.builddir, 'pool', name), ignore_errors=True)
+            del pool[name]
+            print(green('Docker container {} was successful removed from the pool'.format(name)))
+
+
 @task
 @roles('docker')
 def update_host():
@@ -220,9 +574,11 @@ def update_host():
     Update hostname resolution in the container.
     """
 
-    site_hostname = run("hostname")
-    run("sed  '/{}/c\{} {}  localhost.domainlocal' "
-        "/etc/hosts > /root/hosts.backup".format(env.container_ip, env.container_ip, site_hostname))
-    run("cat /root/hosts.backup > /etc/hosts")
+    site_hostname = h.fab_run('docker', "hostname")
+    h.fab_run_batch('docker', [
+        "sed  '/{}/c\{} {}  localhost.domainlocal' "
+        "/etc/hosts > /root/hosts.backup".format(env.container_ip, env.container_ip, site_hostname),
+        "cat /root/hosts.backup > /etc/hosts",
+    ])
 
     h.fab_update_container_ip()
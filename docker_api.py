@@ -0,0 +1,121 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from fabric.api import env
+from fabric.utils import abort
+
+import httplib
+import json
+import socket
+import urllib
+
+
+###########################################################
+# Minimal Docker Engine API client over the unix socket  #
+###########################################################
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """
+    HTTP connection speaking to a unix socket instead of a TCP port.
+    """
+
+    def __init__(self, socket_path, timeout=60):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerClient(object):
+    """
+    Query the Docker daemon through its Engine API.
+    A single keep-alive connection is reused for every request, and reopened once if the daemon dropped it.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get(self, path, **params):
+        """
+        Send a GET request and return the decoded JSON body, or None if the resource does not exist.
+        """
+        if params:
+            path = '{}?{}'.format(path, urllib.urlencode(params))
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = UnixHTTPConnection(self.socket_path)
+            try:
+                self._conn.request('GET', path)
+                response = self._conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error) as error:
+                self.close()
+                if attempt:
+                    abort('Could not query the Docker daemon on {}: {}'.format(self.socket_path, error))
+                continue
+            if response.status == 404:
+                return None
+            if response.status >= 400:
+                abort('Docker daemon answered {} to GET {}: {}'.format(response.status, path, body))
+            return json.loads(body)
+
+    def containers(self, all=True):
+        return self.get('/containers/json', all=int(all))
+
+    def images(self):
+        return self.get('/images/json')
+
+    def inspect_container(self, name):
+        return self.get('/containers/{}/json'.format(name))
+
+    def inspect_image(self, name):
+        return self.get('/images/{}/json'.format(name))
+
+
+_client = None
+
+
+def client():
+    """
+    Return the client shared by the whole Fabric run.
+    """
+    global _client
+    if _client is None or _client.socket_path != env.docker_socket:
+        _client = DockerClient(env.docker_socket)
+    return _client
+
+
+def container_ip(name):
+    """
+    Return the IP address of a container, or None if it does not exist.
+    """
+    info = client().inspect_container(name)
+    if not info:
+        return None
+    return info['NetworkSettings']['IPAddress']
@@ -23,9 +23,12 @@ from fabric.colors import red, green
 from fabric.utils import abort
 
 from datetime import datetime
+from os import path
 
 import helpers as h
 import core as c
+import cache
+import artefacts
 
 from git import isGitDirty
 
@@ -35,6 +38,7 @@ from git import isGitDirty
 def make(action='install'):
     """
     Build the platform by running the Makefile specified in the local_vars.py configuration file.
+    Platforms are cached in build/platforms, an unchanged platform is restored instead of being rebuilt.
     """
 
     if env.get('always_use_pty', True):
@@ -58,10 +62,47 @@ def make(action='install'):
 
     if env.get('always_use_pty', True):
         drush_opts += " --working-copy --no-gitinfofile"
+
+    # Restore the platform from the build cache if the makefiles and the profile did not change.
+    key = cache.platform_key(env.makefile, path.join(env.builddir, env.site_profile), drush_opts)
+    if env.make_cache and cache.restore_platform(key, env.site_root):
+        print(green('Platform {} restored from the build cache into {}.'.format(key, env.site_root)))
+        return
+
     if not h.fab_exists('local', env.site_root):
         h.fab_run('local', "mkdir {}".format(env.site_root))
-    with h.fab_cd('local', env.site_root):
-        h.fab_run('local', 'drush make {} {} -y'.format(drush_opts, env.makefile))
+
+    # Point drush make to the projects of the shared download cache, which is not pruned until they are copied.
+    if env.download_cache:
+        makefile = path.join(env.builddir, 'download-cache.make')
+        with cache.download_cache_lock():
+            hits, misses = cache.cached_makefile(env.makefile, makefile)
+            print(green('Download cache: {} hit(s), {} miss(es).'.format(hits, misses)))
+            with h.fab_cd('local', env.site_root):
+                h.fab_run('local', 'drush make {} {} -y'.format(drush_opts, makefile))
+        cache.prune_download_cache()
+    else:
+        with h.fab_cd('local', env.site_root):
+            h.fab_run('local', 'drush make {} {} -y'.format(drush_opts, env.makefile))
+
+    if env.make_cache:
+        cache.store_platform(key, env.site_root)
+        print(green('Platform {} stored in the build cache.'.format(key)))
+
+@task
+@roles('local')
+def download_cache_seed():
+    """
+    Download the projects of the Makefile into the shared download cache, so that later builds can run offline.
+    """
+
+    h.update_profile()
+    with cache.download_cache_lock():
+        hits, misses = cache.cached_makefile(env.makefile, path.join(env.builddir, 'download-cache.make'))
+    cache.prune_download_cache()
+    print(green('Download cache seeded in {}: {} project(s) already cached, {} downloaded.'.format(
+        env.download_cache_dir, hits, misses)))
+
 
 @task
 @roles('local')
@@ -104,6 +145,8 @@ def updatedb():
 def site_install():
     """
     Run the site installation procedure.
+    The installed site is snapshotted, and later installations with the same profile, makefiles and hooks
+    restore the snapshot instead.
     """
 
     role = 'docker'
@@ -119,6 +162,14 @@ def site_install():
     site_admin_pass = env.site_admin_pass
     site_subdir = env.site_subdir
 
+    # Restore the snapshot of a previous identical installation, if any.
+    key = cache.snapshot_key()
+    snapshot = '{}/build/snapshots/{}'.format(env.docker_workspace, key)
+    if env.install_snapshots and h.fab_exists(role, '{}/db.sql.gz'.format(snapshot)):
+        _restore_snapshot(role, snapshot)
+        print(green('Site restored from the snapshot {}.'.format(key)))
+        return
+
     # Create first the database if necessary
     h.init_db('docker')
 
@@ -141,20 +192,80 @@ def site_install():
 
     h.hook_execute(env.hook_post_install, role)
 
+    if env.install_snapshots:
+        _take_snapshot(role, snapshot)
+        print(green('Snapshot {} of the installed site taken.'.format(key)))
+
+
+def _take_snapshot(role, snapshot):
+    """
+    Dump the database and archive the site directory, settings.php and files included.
+    """
+    tmp = '{}.tmp'.format(snapshot)
+    h.fab_run(role, 'rm -rf {} && mkdir -p {}'.format(tmp, tmp))
+    h.fab_run(role, 'mysqldump -u{} -p{} {} | gzip > {}/db.sql.gz'.format(env.site_db_user, env.site_db_pass,
+                                                                         env.site_db_name, tmp))
+    h.fab_run(role, 'tar -czf {}/site.tar.gz -C {}/sites {}'.format(tmp, env.docker_site_root, env.site_subdir))
+    h.fab_run(role, 'rm -rf {} && mv {} {}'.format(snapshot, tmp, snapshot))
+
+
+def _restore_snapshot(role, snapshot):
+    """
+    Recreate the database and the site directory from a snapshot.
+    """
+    h.fab_run(role, 'mysql -uroot -e "DROP DATABASE IF EXISTS {}"'.format(env.site_db_name))
+    h.init_db(role)
+    h.fab_run(role, 'zcat {}/db.sql.gz | mysql -u{} -p{} {}'.format(snapshot, env.site_db_user, env.site_db_pass,
+                                                                   env.site_db_name))
+    h.fab_run(role, 'rm -rf {}/sites/{} && tar -xzpf {}/site.tar.gz -C {}/sites'.format(
+        env.docker_site_root, env.site_subdir, snapshot, env.docker_site_root))
+    # The modification time tells which snapshots were used last.
+    h.fab_run(role, 'touch {}'.format(snapshot))
+
+
+@task
+@roles('local')
+def snapshot_list():
+    """
+    List the snapshots of installed sites, most recent first.
+    """
+
+    for key, mtime, size in cache.snapshots():
+        print('{}  {}  {:.1f} MB'.format(key, datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S'),
+                                         size / 1024.0 / 1024))
+
+
+@task
+@roles('local')
+def snapshot_prune(keep=1):
+    """
+    Remove the snapshots of installed sites, except the most recent ones.
+    :param keep Number of snapshots to keep
+    """
+
+    for key, mtime, size in cache.snapshots()[int(keep):]:
+        cache.remove_snapshot(key)
+        print(green('Snapshot {} removed.'.format(key)))
+
 
 @task
 @roles('docker')
 def archive_dump(role='docker'):
     """
-    Archive the platform for release or deployment.
+    Archive the platform for release or deployment, and add the archive to the artefact store of build/artefacts.
+    The archive of a build number already in the store is reused instead of being dumped again.
     :param role Default 'role' where to run the task
     """
 
-    with h.fab_cd(role, env.docker_site_root):
-        platform = '{}-{}.tar.gz'.format(env.project_name, datetime.now().strftime('%Y%m%d_%H%M%S'))
-        h.fab_run(role, 'rm -f {}/build/*.tar.gz'.format(env.docker_workspace))
-        print(green('All tar.gz archives found in {}/build have been deleted.'.format(env.docker_workspace)))
+    store = path.join(env.builddir, 'artefacts')
+    build = env.get('build_number') or datetime.now().strftime('%Y%m%d_%H%M%S')
+    if env.get('build_number') and artefacts.find(store, build=build):
+        print(green('The artefact of build {} is already stored: {}.'.format(build,
+                                                                             artefacts.find(store, build=build))))
+        return
 
+    with h.fab_cd(role, env.docker_site_root):
+        platform = '{}-{}.tar.gz'.format(env.project_name, build)
         h.fab_run(
             role,
             'drush archive-dump --destination={}/build/{} --tags="sflinux {}" --generatorversion="2.x" '
@@ -162,6 +273,40 @@ def archive_dump(role='docker'):
             ''.format(env.docker_workspace, platform, env.project_name)
         )
 
+    # The build directory is shared with the container, store the archive and its manifest, used by incremental
+    # provisioning.
+    tarball = path.join(env.builddir, platform)
+    if path.isfile(tarball):
+        sha = artefacts.add(store, tarball, build)
+        print(green('Artefact {} stored for build {}.'.format(sha, build)))
+        for sha in artefacts.prune(store, env.artefact_keep):
+            print(green('Artefact {} removed from the store.'.format(sha)))
+
+
+@task
+@roles('local')
+def artefact_list():
+    """
+    List the artefacts of build/artefacts with their build numbers, most recent first.
+    """
+
+    for sha, entry in artefacts.listing(path.join(env.builddir, 'artefacts')):
+        print('{}  {}  {:.1f} MB  build(s) {}'.format(
+            sha[:12], datetime.fromtimestamp(entry['created']).strftime('%Y-%m-%d %H:%M:%S'),
+            entry['size'] / 1024.0 / 1024, ', '.join(entry['builds'])))
+
+
+@task
+@roles('local')
+def artefact_prune(keep=None):
+    """
+    Remove the artefacts of build/artefacts, except the most recent ones.
+    :param keep Number of artefacts to keep, default to artefact_keep
+    """
+
+    for sha in artefacts.prune(path.join(env.builddir, 'artefacts'), keep or env.artefact_keep):
+        print(green('Artefact {} removed.'.format(sha)))
+
 
 @task
 @roles('docker')
@@ -171,12 +316,16 @@ def gen_doc(role='docker'):
     :param role Default 'role' where to run the task
     """
 
-    if h.fab_exists(role, '{}/README.adoc'.format(env.docker_workspace)):
+    readme = '{}/README.adoc'.format(env.docker_workspace)
+    changelog = '{}/CHANGELOG.adoc'.format(env.docker_workspace)
+    facts = h.fab_facts(role, paths=[readme, changelog])
+
+    if facts[readme]:
         h.fab_run(role, 'asciidoctor -d book -b html5 -o {}/README.html {}/README.adoc'.
                   format(env.docker_workspace, env.docker_workspace))
         print(green('README.html generated in {}'.format(env.docker_workspace)))
 
-    if h.fab_exists(role, '{}/CHANGELOG.adoc'.format(env.docker_workspace)):
+    if facts[changelog]:
         h.fab_run(role, 'asciidoctor -d book -b html5 -o {}/CHANGELOG.html {}/CHANGELOG.adoc'.
                   format(env.docker_workspace, env.docker_workspace))
         print(green('CHANGELOG.html generated in {}'.format(env.docker_workspace)))
@@ -4,11 +4,52 @@ from fabric.api import task, env, local
 from fabric.colors import red, green, yellow
 from fabric.api import task, env, execute
 from fabric.contrib.console import confirm
+from fabric.utils import abort
 from .environments import e
 
 import helpers as h
+from repos import discover, repo_report
+from multiprocessing.pool import ThreadPool
+import gitwatch
+import json
+import pipes
+import sys
 import time
-import re
+
+@task
+def watch_start():
+    """
+    Start a background watcher of the workspace repositories, so git.check_status and drush.make only check the
+    repositories that changed. It uses inotify, or polls every git_watch_interval seconds when inotify is missing.
+    """
+    if gitwatch.query(env.workspace) is not None:
+        print green('The workspace watcher is already running.')
+        return
+
+    log = path.join(env.builddir, 'gitwatch.log')
+    local('nohup {} {} {} --skip={} --index={} --interval={} > {} 2>&1 &'.format(
+        sys.executable, path.join(path.dirname(path.abspath(__file__)), 'gitwatch.py'), pipes.quote(env.workspace),
+        pipes.quote(json.dumps(env.git_discovery_skip)), pipes.quote(_discoveryIndex()), int(env.git_watch_interval),
+        pipes.quote(log)))
+    # The watcher answers once it computed the state of every repository.
+    for attempt in range(120):
+        status = gitwatch.query(env.workspace)
+        if status is not None:
+            print green('The workspace watcher is running on {} repositories, {}.'.format(
+                status['repos'], 'with inotify' if status['inotify'] else 'polling'))
+            return
+        time.sleep(1)
+    abort('The workspace watcher did not start, see {}.'.format(log))
+
+@task
+def watch_stop():
+    """
+    Stop the background watcher of the workspace repositories.
+    """
+    if gitwatch.query(env.workspace, 'stop') is None:
+        print yellow('The workspace watcher is not running.')
+    else:
+        print green('The workspace watcher is stopped.')
 
 @task(alias='is_dirty')
 def check_status():
@@ -22,11 +63,25 @@ def check_status():
         print green('Your workspace is clean.')
 
 def isGitDirty():
-    repos = local('find ' + path.normpath(env.workspace) + ' -name ".git"', capture=True).splitlines()
+    watched = gitwatch.query(env.workspace)
+    if watched is not None:
+        # The watcher knows which repositories are dirty, only those are checked.
+        repos = watched['dirty']
+        print green('Workspace watcher: {} dirty repositories out of {}.'.format(len(repos), watched['repos']))
+    else:
+        # The directories of git_discovery_skip are not walked, and the walk is cached in build/git-repos.json.
+        repos = discover(env.workspace, env.git_discovery_skip, _discoveryIndex())
+
+    # Query the repositories in parallel, then report and prompt one repository at a time.
+    pool = ThreadPool(max(1, min(int(env.git_check_workers), len(repos))))
+    try:
+        reports = pool.map(repo_report, repos)
+    finally:
+        pool.close()
+
     nbWarnings = 0
-    for repo in repos:
-        repoLocalPath = path.normpath(path.join(repo, '..'))
-        nbWarnings += _checkRepo(repoLocalPath)
+    for report in reports:
+        nbWarnings += _checkRepo(report)
 
     return (nbWarnings > 0)
 
@@ -39,59 +94,58 @@ def isGitDirty():
     # - attention aux conflits, faire un pull d'abord et valider la fusion automatique
 
 
-def _checkRepo(repoLocalPath):
+def _discoveryIndex():
+    return path.join(env.builddir, 'git-repos.json')
+
+
+def _checkRepo(report):
     nbWarnings = 0
+    repoLocalPath = report['path']
     with h.fab_cd('local', repoLocalPath):
         print green('---')
         print green('Verify repo in ' + repoLocalPath)
 
-        remoteName = local('git remote', capture=True)
+        if report['error'] is not None:
+            print yellow('Could not verify the repository: {}'.format(report['error']))
+            return 1
 
-        filesStatusRawInfo = _getFilesStatusInformation()
         print green('Verify local files status against current HEAD commit...')
-        nbWarnings += _checkFilesStatusVsHeadCommit(filesStatusRawInfo)
+        nbWarnings += _checkFilesStatusVsHeadCommit(report['files'])
 
-        localBranchesRawInfo = _getLocalBranchesInformation()
-        print green('Verify local branches exist on remote "' + remoteName + '"...');
-        nbWarnings += _checkLocalBranchesExistOnRemote(localBranchesRawInfo, remoteName)
+        print green('Verify local branches exist on remote "' + report['remote'] + '"...');
+        nbWarnings += _checkLocalBranchesExistOnRemote(report['notOnRemote'], report['remote'])
 
         print green('Verify branches status against remote...');
-        nbWarnings += _checkLocalBranchesStatusVsRemote(localBranchesRawInfo, remoteName)
+        nbWarnings += _checkLocalBranchesStatusVsRemote(report['ahead'], report['remote'])
 
         return nbWarnings
 
 
-def _checkFilesStatusVsHeadCommit(filesStatusRawInfo):
+def _checkFilesStatusVsHeadCommit(filesStatus):
     nbWarnings = 0
     addableFiles = []
-    if (len(filesStatusRawInfo) > 0):
-        for fileStatus in filesStatusRawInfo:
-            fileStatusData = fileStatus.split()
-            # Break loop if filename is "fabfile"
-            if fileStatusData[1] == 'fabfile':
-                break
-            nbWarnings += 1
-            addableFiles.append(fileStatusData[1])
-            print yellow('File "' + fileStatusData[1] + '" ' + {
-                'M': 'has un-commited modifications.',
-                'D': 'has been deleted.',
-                '??': 'is not indexed.',
-            }.get(fileStatusData[0], 'is in an unknown state (' + fileStatusData[0] + ')'))
+    for fileStatus, fileName in filesStatus:
+        # Break loop if filename is "fabfile"
+        if fileName == 'fabfile':
+            break
+        nbWarnings += 1
+        addableFiles.append(fileName)
+        print yellow('File "' + fileName + '" ' + {
+            'M': 'has un-commited modifications.',
+            'D': 'has been deleted.',
+            '??': 'is not indexed.',
+        }.get(fileStatus, 'is in an unknown state (' + fileStatus + ')'))
 
     return nbWarnings
 
-def _checkLocalBranchesExistOnRemote(localBranchesRawInfo, remoteName):
+def _checkLocalBranchesExistOnRemote(pushableBranches, remoteName):
     nbWarnings = 0
-    pushableBranches = []
-    for localBranchRawInfo in localBranchesRawInfo:
-        localBranchName = _getBranchName(localBranchRawInfo)
-        if ((localBranchName is not None) and (not _remoteBranchExists(localBranchName))):
-            nbWarnings += 1
-            pushableBranches.append(localBranchName)
-            print yellow('Local branch "' + localBranchName + '" is not present on "' + remoteName + '" remote.')
+    for localBranchName in pushableBranches:
+        nbWarnings += 1
+        print yellow('Local branch "' + localBranchName + '" is not present on "' + remoteName + '" remote.')
 
     # On suggere de pusher la(les) branche(s) qui sont seulement sur le local
-    if (nbWarnings > 0):
+    if (nbWarnings > 0 and remoteName):
         if (confirm(red('There are many local branches not present on remote. Do you want to sync theses?'), default=False)):
             for branchName in pushableBranches:
                 local('git push --set-upstream ' + remoteName + ' ' + branchName)
@@ -100,18 +154,11 @@ def _checkLocalBranchesExistOnRemote(localBranchesRawInfo, remoteName):
 
     return nbWarnings
 
-def _checkLocalBranchesStatusVsRemote(localBranchesRawInfo, remoteName):
+def _checkLocalBranchesStatusVsRemote(pushableBranches, remoteName):
     nbWarnings = 0
-    pushableBranches = []
-    # on gere un git FR ou EN, a voir ce qu'on peut faire
-    # pour une internationalisation plus cool..
-    pattern = re.compile('.*\[.* (ahead|en avance de) .*\].*')
-    for localBranchRawInfo in localBranchesRawInfo:
-        if (pattern.match(localBranchRawInfo)):
-            localBranchName = _getBranchName(localBranchRawInfo)
-            nbWarnings += 1
-            pushableBranches.append(localBranchName)
-            print yellow('Local branch "' + localBranchName + '" is ahead of remote branch.');
+    for localBranchName in pushableBranches:
+        nbWarnings += 1
+        print yellow('Local branch "' + localBranchName + '" is ahead of remote branch.');
 
     # On suggere de pusher la(les) branche(s) qui sont seulement sur le local
     if (nbWarnings > 0):
@@ -121,28 +168,4 @@ def _checkLocalBranchesStatusVsRemote(localBranchesRawInfo, remoteName):
             # Do not alert with diff as local branches are now pushed
             nbWarnings = 0
 
-    # TO DO : PUSHER LA BRANCHE SUR LE REPO
-
     return nbWarnings
-
-def _getLocalBranchesInformation():
-    return local('git branch --list -vv', capture=True).splitlines()
-
-def _getBranchName(branchRawData):
-    branchName = branchRawData.replace('*', '').strip()
-    if (_isBranchDetached(branchName)):
-        return None
-    else:
-        return branchName.split()[0]
-
-def _isBranchDetached(branchName):
-    pattern = re.compile('\(.*\)')
-    return pattern.match(branchName)
-
-
-def _remoteBranchExists(branchName):
-    return (len(local('git branch --list --remote "*' + branchName + '"', capture=True).splitlines()) > 0)
-
-
-def _getFilesStatusInformation():
-    return local('git status -s', capture=True).splitlines()
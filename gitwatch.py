@@ -0,0 +1,330 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from fnmatch import fnmatch
+from os import path
+
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import repos
+
+
+#####################################################################
+# Watcher of the dirty state of the repositories of a workspace     #
+#####################################################################
+
+# The watcher runs as a background process, started by git.watch_start. It keeps a report per repository, computes
+# it again when inotify tells something changed in the repository, and answers the dirty repositories on a unix
+# socket. Without inotify, or when the watches are exhausted, the reports are computed again every interval.
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF
+
+_event = struct.Struct(str('iIII'))
+
+
+def socket_path(workspace):
+    """
+    Return the socket of the watcher of a workspace. It is in /tmp, unix socket paths are limited to 108 bytes.
+    """
+    digest = hashlib.sha1(path.normpath(workspace).encode('utf-8')).hexdigest()[:12]
+    return '/tmp/drupalizer-gitwatch-{}.sock'.format(digest)
+
+
+def query(workspace, command='status', timeout=30):
+    """
+    Send a command to the watcher of a workspace.
+    :return: the decoded answer, or None if no watcher is running
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path(workspace))
+        client.sendall('{}\n'.format(command).encode('utf-8'))
+        chunks = []
+        for chunk in iter(lambda: client.recv(65536), b''):
+            chunks.append(chunk)
+    except socket.error:
+        return None
+    finally:
+        client.close()
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+class Inotify(object):
+    """
+    Minimal inotify binding through ctypes.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library(str('c')) or str('libc.so.6'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_CLOEXEC if hasattr(os, 'O_CLOEXEC') else 0o2000000)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding() or 'utf-8'),
+                                          WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on {}'.format(directory))
+        self.watches[wd] = directory
+
+    def read(self):
+        """
+        Block until events are available.
+        :return: a list of (directory, mask, name) tuples
+        """
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, offset)
+            name = data[offset + _event.size:offset + _event.size + length].rstrip(b'\0')
+            offset += _event.size + length
+            if mask & IN_IGNORED:
+                # The directory was removed, its watch is gone.
+                self.watches.pop(wd, None)
+                continue
+            events.append((self.watches.get(wd), mask, repos._decode(name)))
+        return events
+
+
+class Watcher(object):
+
+    def __init__(self, root, skip, index_file, interval):
+        self.root = repos._decode(path.normpath(root))
+        self.skip = skip
+        self.index_file = index_file
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.reports = {}
+        self.git_dirs = {}
+        self.stale = set()
+        self.inotify = None
+        self.updated = 0
+
+    def _git_dir(self, repo):
+        # Submodules and worktrees have a .git file pointing to their git directory.
+        git_dir = path.join(repo, '.git')
+        if path.isfile(git_dir):
+            with open(git_dir) as f:
+                content = f.read().strip()
+            if content.startswith('gitdir:'):
+                git_dir = path.normpath(path.join(repo, content[len('gitdir:'):].strip()))
+        return git_dir
+
+    def _watch(self, directories):
+        try:
+            for directory in directories:
+                self.inotify.add(directory)
+        except OSError as error:
+            # Usually fs.inotify.max_user_watches is reached: fall back to polling.
+            print('Watching the workspace failed ({}), polling it every {}s instead.'.format(error.args[-1],
+                                                                                          self.interval))
+            os.close(self.inotify.fd)
+            self.inotify = None
+
+    def _git_directories(self, repo):
+        # The HEAD, packed-refs and the branches of a repository. The index is left out, git status rewrites it.
+        git_dir = self._git_dir(repo)
+        directories = [git_dir]
+        for dirpath, dirnames, filenames in os.walk(path.join(git_dir, 'refs')):
+            directories.append(dirpath)
+        return directories
+
+    def scan(self):
+        """
+        Discover the repositories and watch the directories of the workspace and of the repositories.
+        """
+        directories = repos.walk(self.root, self.skip, self.index_file)
+        found = sorted(path.join(self.root, relative) if relative else self.root
+                       for relative, entry in directories.items() if entry[2])
+        with self.lock:
+            self.stale.update(repo for repo in found if repo not in self.reports)
+            for repo in list(self.reports):
+                if repo not in found:
+                    del self.reports[repo]
+                    del self.git_dirs[repo]
+            for repo in found:
+                self.reports.setdefault(repo, None)
+                self.git_dirs[repo] = self._git_dir(repo)
+        if self.inotify is not None:
+            watched = set(self.inotify.watches.values())
+            new = [path.join(self.root, relative) if relative else self.root for relative in directories]
+            for repo in found:
+                new.extend(self._git_directories(repo))
+            self._watch(directory for directory in new if directory not in watched)
+
+    def _repo_of(self, directory):
+        # The innermost repository holding a directory of a worktree or a git directory.
+        best = None
+        for repo, git_dir in self.git_dirs.items():
+            if directory in (repo, git_dir) or directory.startswith(repo + os.sep) or \
+                    directory.startswith(git_dir + os.sep):
+                if best is None or len(repo) > len(best):
+                    best = repo
+        return best
+
+    def _skipped(self, directory):
+        relative = path.relpath(directory, self.root)
+        return any(fnmatch(relative, pattern) for pattern in self.skip)
+
+    def watch(self):
+        """
+        Mark the repositories as stale when inotify reports a change, until the process exits.
+        """
+        while self.inotify is not None:
+            rescan = False
+            try:
+                events = self.inotify.read()
+            except OSError:
+                # The watches were dropped for polling.
+                return
+            for directory, mask, name in events:
+                if mask & IN_Q_OVERFLOW or directory is None:
+                    rescan = True
+                    with self.lock:
+                        self.stale.update(self.reports)
+                    continue
+                if name == 'index' or name.endswith('.lock'):
+                    continue
+                if name == '.git' or (mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and
+                                      not self._skipped(path.join(directory, name))):
+                    rescan = True
+                repo = self._repo_of(directory)
+                if repo is not None:
+                    with self.lock:
+                        self.stale.add(repo)
+            if rescan:
+                self.scan()
+
+    def poll(self):
+        """
+        Without inotify, compute every report again each interval.
+        """
+        while True:
+            time.sleep(self.interval)
+            if self.inotify is None:
+                self.scan()
+                with self.lock:
+                    self.stale.update(self.reports)
+                self.refresh()
+
+    def refresh(self):
+        """
+        Compute the reports of the stale repositories.
+        """
+        with self.lock:
+            stale = list(self.stale)
+            self.stale.clear()
+        for repo in stale:
+            report = repos.repo_report(repo)
+            with self.lock:
+                if repo in self.reports:
+                    self.reports[repo] = report
+        self.updated = time.time()
+
+    def status(self):
+        # With inotify, the changes not handled yet are handled before answering.
+        if self.inotify is not None:
+            self.refresh()
+        with self.lock:
+            return {
+                'repos': len(self.reports),
+                'dirty': sorted(repo for repo, report in self.reports.items() if report and repos.is_dirty(report)),
+                'inotify': self.inotify is not None,
+                'age': time.time() - self.updated,
+            }
+
+    def serve(self, socket_file):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if path.exists(socket_file):
+            os.remove(socket_file)
+        server.bind(socket_file)
+        os.chmod(socket_file, 0o600)
+        server.listen(5)
+        try:
+            while True:
+                client, address = server.accept()
+                try:
+                    command = client.makefile().readline().strip()
+                    if command == 'stop':
+                        client.sendall(json.dumps({'stopped': True}).encode('utf-8'))
+                        return
+                    client.sendall(json.dumps(self.status()).encode('utf-8'))
+                except socket.error:
+                    pass
+                finally:
+                    client.close()
+        finally:
+            server.close()
+            os.remove(socket_file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Watch the dirty state of the git repositories of a workspace.')
+    parser.add_argument('workspace')
+    parser.add_argument('--skip', default='[]', help='JSON list of the fnmatch patterns of the directories to skip')
+    parser.add_argument('--index', default=None, help='Index file of the directories walked')
+    parser.add_argument('--interval', type=int, default=10, help='Polling interval without inotify')
+    args = parser.parse_args(argv)
+
+    watcher = Watcher(args.workspace, json.loads(args.skip), args.index, args.interval)
+    try:
+        watcher.inotify = Inotify()
+    except OSError as error:
+        print('inotify is not available ({}), polling the workspace every {}s instead.'.format(error.args[-1],
+                                                                                            args.interval))
+    watcher.scan()
+    watcher.refresh()
+    for target in (watcher.watch, watcher.poll):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    watcher.serve(socket_path(args.workspace))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
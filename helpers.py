@@ -18,13 +18,26 @@
 
 from __future__ import unicode_literals
 from getpass import getuser
-from fabric.api import lcd, cd, roles, local, run
+from fabric.api import lcd, cd, roles, local, run, put, settings, hide
 from fabric.colors import green
 from fabric.contrib.console import confirm
-from fabric.contrib.files import exists
+from fabric.state import connections
+from fabric.utils import abort
 
 # Import socket to find the localhost IP address
 import socket
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import pipes
+import posixpath
+import shlex
+import tempfile
+import time
+
+import docker_api
 
 # Import default variables
 from default_vars import *
@@ -50,6 +63,23 @@ env.builddir = path.join(env.workspace, 'build')
 env.makefile = path.join(env.builddir, env.site_profile, env.site_profile_makefile)
 env.site_drush_aliases = path.join(env.site_root, 'sites/all/drush')
 
+# Connection setup and command times per host, reported by ssh_report().
+_ssh_stats = {}
+
+
+def fab_connect():
+    """
+    Helper function to open the SSH connection to the current host, once for the whole run
+    :return: the statistics of the current host
+    """
+    stats = _ssh_stats.setdefault(env.host_string, {'connect': 0.0, 'commands': 0, 'command_time': 0.0})
+    if env.host_string not in connections:
+        start = time.time()
+        connections.connect(env.host_string)
+        stats['connect'] += time.time() - start
+    return stats
+
+
 def fab_run(role="local", cmd="", capture=False):
     """
     Helper function to run the task locally or remotely
@@ -61,7 +91,54 @@ def fab_run(role="local", cmd="", capture=False):
     if role == "local":
         return local(cmd, capture)
     else:
-        return run(cmd)
+        # The command may change what the facts gathered on the host tell.
+        _facts.pop(env.host_string, None)
+        stats = fab_connect()
+        start = time.time()
+        try:
+            return run(cmd)
+        finally:
+            stats['commands'] += 1
+            stats['command_time'] += time.time() - start
+
+
+def fab_run_batch(role, cmds):
+    """
+    Helper function to run several short commands in a single round trip, stopping at the first failure
+    :param role: the role to use for define the host
+    :param cmds: the commands to execute
+    """
+    return fab_run(role, ' && '.join('({})'.format(cmd) for cmd in cmds))
+
+
+def ssh_options():
+    """
+    Helper function returning the OpenSSH options sharing one master connection per host,
+    for the commands spawning their own ssh client like rsync
+    """
+    return '-o ControlMaster=auto -o ControlPath={} -o ControlPersist={}'.format(env.ssh_control_path,
+                                                                                env.ssh_control_persist)
+
+
+def ssh_merge(host, stats):
+    """
+    Helper function to add the SSH statistics gathered on a host by a forked process, as parallel tasks are
+    :param host: the host of the statistics
+    :param stats: the connection setup time, number of commands and command time to add
+    """
+    total = _ssh_stats.setdefault(host, {'connect': 0.0, 'commands': 0, 'command_time': 0.0})
+    for key, value in stats.items():
+        total[key] = total.get(key, 0) + value
+
+
+def ssh_report():
+    """
+    Helper function to print the SSH connection setup and command times of each host
+    """
+    for host in sorted(_ssh_stats):
+        stats = _ssh_stats[host]
+        print(green('{}: connection {:.2f}s, {} command(s) {:.2f}s'.format(host, stats['connect'], stats['commands'],
+                                                                         stats['command_time'])))
 
 
 def fab_cd(role, directory):
@@ -84,10 +161,65 @@ def fab_exists(role, directory):
     :param directory: the directory to check
     :return: the function for check the existence of the directory locally or remotely
     """
+    return fab_facts(role, paths=[directory])[directory]
+
+
+# Facts gathered on each remote host, dropped as soon as another command runs on that host.
+_facts = {}
+
+# Shell tests of each kind of fact.
+FACT_TESTS = {
+    'path': 'test -e {}',
+    'binary': 'command -v {} > /dev/null 2>&1',
+    'service': '(service {0} status || pgrep -x {0}) > /dev/null 2>&1',
+}
+
+
+def fab_facts(role, paths=(), binaries=(), services=()):
+    """
+    Helper function to check paths, binaries and services in a single round trip
+    :param role: the role to use for define the host
+    :param paths: the paths that should exist
+    :param binaries: the binaries that should be in the PATH
+    :param services: the services that should be running
+    :return: a dict telling for each path, binary and service if it exists
+    """
+    queries = [('path', p) for p in paths] + [('binary', b) for b in binaries] + [('service', s) for s in services]
     if role == "local":
-        return path.exists(directory)
+        return dict((name, path.exists(path.join(env.lcwd, name)) if kind == 'path' else
+                     local(FACT_TESTS[kind].format(pipes.quote(name)) + ' && echo 1 || echo 0', capture=True) == '1')
+                    for kind, name in queries)
+
+    # Relative paths depend on the current directory.
+    cached = _facts.setdefault(env.host_string, {})
+    keys = [(kind, posixpath.join(env.cwd, name) if kind == 'path' else name) for kind, name in queries]
+    missing = [key for key in keys if key not in cached]
+    if missing:
+        cmd = '; '.join('{} && echo "FACT{}:1" || echo "FACT{}:0"'.format(
+            FACT_TESTS[kind].format(pipes.quote(name)), i, i) for i, (kind, name) in enumerate(missing))
+        with settings(hide('running', 'stdout')):
+            output = fab_run(role, cmd, capture=True)
+        answers = dict(line.strip()[4:].split(':') for line in output.splitlines() if line.startswith('FACT'))
+        _facts.setdefault(env.host_string, {}).update(
+            (key, answers.get(str(i)) == '1') for i, key in enumerate(missing))
+        cached = _facts[env.host_string]
+    return dict((name, cached[key]) for (kind, name), key in zip(queries, keys))
+
+
+def fab_put(role, local_path, remote_path, mode=None):
+    """
+    Helper function to copy a local file to the host of the role
+    :param role: the role to use for define the host
+    :param local_path: the file to copy
+    :param remote_path: the destination of the file
+    :param mode: the permissions of the copied file
+    """
+    if role == "local":
+        local('cp {} {}'.format(local_path, remote_path))
+        if mode is not None:
+            os.chmod(remote_path, mode)
     else:
-        return exists(directory)
+        put(local_path, remote_path, mode=mode)
 
 
 def fab_add_to_hosts(ip, site_hostname):
@@ -135,12 +267,143 @@ def fab_update_hosts(ip, site_hostname):
     fab_add_to_hosts(ip, site_hostname)
 
 
+# PHP script run by "drush php-script": it runs every step with the Drupal bootstrap of the drush process.
+# Drush steps are invoked in-process, other steps are run by the shell.
+DRUSH_BATCH_SCRIPT = """<?php
+$steps = json_decode(base64_decode('%s'), TRUE);
+$commands = drush_get_commands();
+foreach ($steps as $i => $step) {
+  $start = microtime(TRUE);
+  if (isset($step['shell'])) {
+    $output = array();
+    exec($step['shell'] . ' 2>&1', $output, $status);
+    print implode("\\n", $output) . "\\n";
+    $ok = $status == 0;
+  }
+  else {
+    drush_set_context('DRUSH_AFFIRMATIVE', $step['yes']);
+    foreach ($step['options'] as $name => $value) {
+      drush_set_option($name, $value);
+    }
+    $name = isset($commands[$step['command']]) ? $commands[$step['command']]['command'] : $step['command'];
+    $result = drush_invoke($name, $step['arguments']);
+    $ok = $result !== FALSE && !drush_get_error();
+    foreach ($step['options'] as $name => $value) {
+      drush_unset_option($name);
+    }
+  }
+  printf("DRUPALIZER_STEP %%d %%s %%.3f\\n", $i, $ok ? 'ok' : 'failed', microtime(TRUE) - $start);
+  if (!$ok) {
+    exit(1);
+  }
+}
+"""
+
+
+def _drush_batch_step(cmd):
+    """
+    Turn a command line into a step of the drush batch script.
+    """
+    tokens = shlex.split(cmd)
+    if not tokens or tokens[0] != 'drush' or any(token in ('|', '&&', '||', ';', '>', '<') for token in tokens):
+        return {'shell': cmd}
+    step = {'command': None, 'arguments': [], 'options': {}, 'yes': False}
+    for token in tokens[1:]:
+        if token in ('-y', '--yes'):
+            step['yes'] = True
+        elif token.startswith('--'):
+            name, separator, value = token[2:].partition('=')
+            if name in ('root', 'uri', 'alias-path', 'config'):
+                # Those options change the bootstrap, the command needs a drush process of its own.
+                return {'shell': cmd}
+            step['options'][name] = value if separator else True
+        elif token.startswith('-') or token.startswith('@'):
+            # Short options and site aliases need a drush process of their own.
+            return {'shell': cmd}
+        elif step['command'] is None:
+            step['command'] = token
+        else:
+            step['arguments'].append(token)
+    return step
+
+
+# Database updates need the update bootstrap of drush, while the batch fully bootstraps the new code against the
+# schema not updated yet.
+UPDATE_COMMANDS = ('updatedb', 'updb')
+
+
+def _is_update(cmd):
+    tokens = shlex.split(cmd)
+    if tokens[:1] != ['drush']:
+        return False
+    commands = [token for token in tokens[1:] if not token.startswith('-') and not token.startswith('@')]
+    return bool(commands) and commands[0] in UPDATE_COMMANDS
+
+
+def drush_batch(role, cmds, root):
+    """
+    Run a list of commands in a single drush process, bootstrapping Drupal once.
+    The commands up to the last database update run in drush processes of their own, before the batch.
+    Stop at the first failing command.
+    :param role: the role to use for define the host
+    :param cmds: the command lines to run
+    :param root: the Drupal root
+    :return: a list of dicts with the command, its status and the seconds it took, for each command ran
+    """
+    updates = [i for i, cmd in enumerate(cmds) if _is_update(cmd)]
+    separate, cmds = (cmds[:updates[-1] + 1], cmds[updates[-1] + 1:]) if updates else ([], cmds)
+    results = []
+    for cmd in separate:
+        start = time.time()
+        with fab_cd(role, root), settings(warn_only=True):
+            output = fab_run(role, cmd, capture=True)
+        if role == 'local':
+            print(output)
+        if output.failed:
+            abort('Command "{}" failed.'.format(cmd))
+        results.append({'command': cmd, 'status': 'ok', 'seconds': time.time() - start})
+    if not cmds:
+        return results
+
+    steps = [_drush_batch_step(cmd) for cmd in cmds]
+    script = DRUSH_BATCH_SCRIPT % base64.b64encode(json.dumps(steps).encode('utf-8')).decode('ascii')
+    remote_script = '/tmp/drupalizer-batch-{}.php'.format(os.getpid())
+    with tempfile.NamedTemporaryFile(suffix='.php') as f:
+        f.write(script.encode('utf-8'))
+        f.flush()
+        fab_put(role, f.name, remote_script)
+
+    with fab_cd(role, root), settings(warn_only=True):
+        output = fab_run(role, 'drush --root={} php-script {}; status=$?; rm -f {}; exit $status'.format(
+            root, remote_script, remote_script), capture=True)
+    if role == 'local':
+        print(output)
+
+    batch = []
+    for line in output.splitlines():
+        if line.startswith('DRUPALIZER_STEP '):
+            i, status, seconds = line.split()[1:]
+            batch.append({'command': cmds[int(i)], 'status': status, 'seconds': float(seconds)})
+    failed = [result for result in batch if result['status'] != 'ok']
+    if failed or output.failed:
+        # The batch stops at the first failure, which is the last step reported or the one that did not report.
+        index = len(batch) - 1 if failed else min(len(batch), len(cmds) - 1)
+        abort('Command "{}" failed.'.format(cmds[index]))
+    return results + batch
+
+
 def hook_execute(cmds=env.hook_post_install, role='docker'):
     """
     Execute a list of drush commands after the installation or update process
+    With env.hook_batch, the commands run in a single drush process that bootstraps Drupal once.
     :param role Default 'role' where to run the task
     :param cmds Drush commands to run, default to POST_INSTALL, it could be POST_UPDATE too.
     """
+    if env.hook_batch and cmds:
+        for result in drush_batch(role, cmds, env.docker_site_root):
+            print(green('{:8.2f}s  {}'.format(result['seconds'], result['command'])))
+        return
+
     for cmd in cmds:
         with fab_cd(role, env.docker_site_root):
             fab_run(role, cmd)
@@ -158,18 +421,57 @@ def copy_public_ssh_keys(role='local'):
         print green('Public SSH key copied successful to {}/conf directory'.format(env.workspace))
 
 
+def profile_mirror():
+    """
+    Create or update the bare mirror of the profile repository in git_mirror_dir, shared by every workspace.
+    Only site_profile_branch is fetched.
+    :return: the path of the mirror, or None if git_mirror_dir is not set
+    """
+    if not env.git_mirror_dir:
+        return None
+    root = path.expanduser(env.git_mirror_dir)
+    if not path.isdir(root):
+        os.makedirs(root)
+    name = posixpath.basename(env.site_profile_repo.rstrip('/'))
+    name = (name[:-len('.git')] if name.endswith('.git') else name) or 'profile'
+    digest = hashlib.sha1(env.site_profile_repo.encode('utf-8')).hexdigest()[:12]
+    mirror = path.join(root, '{}-{}.git'.format(name, digest))
+
+    # Workspaces may update the mirror at the same time.
+    with open('{}.lock'.format(mirror), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not path.isdir(mirror):
+            local('git init --quiet --bare {} && git --git-dir={} remote add origin {}'.format(
+                mirror, mirror, pipes.quote(env.site_profile_repo)))
+        local('git --git-dir={} fetch --quiet --prune origin +refs/heads/{}:refs/heads/{}'.format(
+            mirror, env.site_profile_branch, env.site_profile_branch))
+    return mirror
+
+
 def update_profile(role='local'):
     """
     Update or clone the installation profile specified in the configuration file.
     The build file included will be used to build the application.
+    Clones borrow the objects of the mirror of git_mirror_dir, and only fetch site_profile_branch, with a history
+    of site_profile_depth commits if set. Updates are fast-forwards of site_profile_branch, local changes are kept.
     """
-    if fab_exists(role, '{}/{}'.format(env.builddir, env.site_profile)):
-        with fab_cd(role, path.join(env.builddir, env.site_profile)):
-            fab_run(role, 'git checkout . && git pull')
-            print green('{} installation profile updated in {}/{}'.format(env.site_profile, env.builddir, env.site_profile))
+    profile_dir = '{}/{}'.format(env.builddir, env.site_profile)
+    if fab_exists(role, profile_dir):
+        with fab_cd(role, path.join(env.builddir, env.site_profile)), settings(warn_only=True):
+            result = fab_run(role, 'git pull --ff-only origin {}'.format(env.site_profile_branch))
+        if result.failed:
+            abort('The {} installation profile could not be fast-forwarded to origin/{}. Commit, stash or rebase '
+                  'the changes of {} first.'.format(env.site_profile, env.site_profile_branch, profile_dir))
+        print green('{} installation profile updated in {}/{}'.format(env.site_profile, env.builddir, env.site_profile))
     else:
+        options = '--branch={} --single-branch'.format(env.site_profile_branch)
+        if int(env.site_profile_depth):
+            options += ' --depth={}'.format(int(env.site_profile_depth))
+        mirror = profile_mirror() if role == 'local' else None
+        if mirror:
+            options += ' --reference={} --dissociate'.format(mirror)
         with fab_cd(role, env.builddir):
-            fab_run(role, 'git clone --branch={} {} {}'.format(env.site_profile_branch, env.site_profile_repo, env.site_profile))
+            fab_run(role, 'git clone {} {} {}'.format(options, env.site_profile_repo, env.site_profile))
             print green('{} installation profile cloned in {}/{}'.format(env.site_profile, env.builddir, env.site_profile))
 
 
@@ -180,8 +482,7 @@ def init_db(role='docker'):
     Create a database and a user that can access it.
     """
 
-    container_ip = fab_run('local', 'docker inspect -f "{{{{.NetworkSettings.IPAddress}}}}" '
-                                                 '{}_container'.format(env.project_name), capture=True)
+    container_ip = env.host or docker_api.container_ip('{}_container'.format(env.project_name))
     docker_iface_ip = [(s.connect((container_ip, 80)), s.getsockname()[0], s.close())
                                    for s in [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]][0][1]
 
@@ -0,0 +1,188 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from fnmatch import fnmatch
+from os import path
+
+import json
+import os
+import stat
+import subprocess
+import sys
+
+
+#####################################################################
+# Discovery of the git repositories of a workspace                  #
+#####################################################################
+
+# The index records, for each directory walked, its modification time, its subdirectories and whether it holds a
+# .git entry. A directory whose modification time did not change has the same entries, so it is not listed again:
+# a repeated discovery only stats the directories and lists the ones that changed.
+
+def _load_index(index_file, root, skip):
+    if not index_file or not path.isfile(index_file):
+        return {}
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+    except ValueError:
+        return {}
+    if index.get('root') != root or index.get('skip') != list(skip):
+        return {}
+    return index['directories']
+
+
+def _save_index(index_file, root, skip, directories):
+    if not path.isdir(path.dirname(index_file)):
+        os.makedirs(path.dirname(index_file))
+    tmp = '{}.tmp'.format(index_file)
+    with open(tmp, 'w') as f:
+        json.dump({'root': root, 'skip': list(skip), 'directories': directories}, f)
+    os.rename(tmp, index_file)
+
+
+def _scan(directory):
+    # List the subdirectories, without following links, and tell whether the directory is a repository. The .git
+    # entry is a directory, or a file in submodules and worktrees, and is never walked into.
+    subdirs = []
+    is_repo = False
+    for name in os.listdir(directory):
+        if name == '.git':
+            is_repo = True
+        elif isinstance(name, type('')):
+            try:
+                if stat.S_ISDIR(os.lstat(path.join(directory, name)).st_mode):
+                    subdirs.append(name)
+            except OSError:
+                pass
+    return sorted(subdirs), is_repo
+
+
+def walk(root, skip=(), index_file=None):
+    """
+    Walk the directories under root, without walking into .git directories.
+    :param skip fnmatch patterns of the directories not to walk, relative to root. '*' also matches '/', so
+    '*node_modules' matches every node_modules directory.
+    :param index_file The file of the index of the directories walked, revalidated by their modification time
+    :return: a dict of the directories walked, relative to root, to their modification time, their subdirectories
+    and whether they hold a repository
+    """
+    root = _decode(path.normpath(root))
+    old = _load_index(index_file, root, skip)
+    directories = {}
+    stack = ['']
+    while stack:
+        relative = stack.pop()
+        directory = path.join(root, relative) if relative else root
+        try:
+            mtime = os.stat(directory).st_mtime
+            cached = old.get(relative)
+            if cached and cached[0] == mtime:
+                subdirs, is_repo = cached[1], cached[2]
+            else:
+                subdirs, is_repo = _scan(directory)
+        except OSError:
+            continue
+        directories[relative] = [mtime, subdirs, is_repo]
+        for name in subdirs:
+            child = path.join(relative, name) if relative else name
+            if not any(fnmatch(child, pattern) for pattern in skip):
+                stack.append(child)
+
+    if index_file:
+        _save_index(index_file, root, skip, directories)
+    return directories
+
+
+def discover(root, skip=(), index_file=None):
+    """
+    Find the git repositories under root, including the nested ones. See walk().
+    :return: the sorted list of the repository directories
+    """
+    root = _decode(path.normpath(root))
+    directories = walk(root, skip, index_file)
+    return sorted(path.join(root, relative) if relative else root
+                  for relative, entry in directories.items() if entry[2])
+
+
+def _decode(name):
+    if not isinstance(name, type('')):
+        name = name.decode(sys.getfilesystemencoding() or 'utf-8')
+    return name
+
+
+#####################################################################
+# State of a repository                                             #
+#####################################################################
+
+def git(repo, *args):
+    """
+    Run git in a repository and return its output. Fabric's local() is not thread safe, subprocess is used.
+    Git runs in the C locale, as the output is parsed, and without optional locks, so reading the state of a
+    repository does not rewrite its index.
+    """
+    git_env = dict(os.environ, LC_ALL='C', GIT_OPTIONAL_LOCKS='0')
+    process = subprocess.Popen(('git',) + args, cwd=repo, env=git_env, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('git {} failed in {}: {}'.format(' '.join(args), repo, _decode(err).strip()))
+    return _decode(out)
+
+
+def repo_report(repo):
+    """
+    Gather the state of a repository in three git processes, whatever its number of branches.
+    :return: a dict with the repository path, its first remote, the changed files as (status, file) tuples, the
+    local branches missing on the remote, the local branches ahead of their upstream, and the error met if any
+    """
+    report = {'path': repo, 'remote': '', 'files': [], 'notOnRemote': [], 'ahead': [], 'error': None}
+    try:
+        remotes = git(repo, 'remote').split()
+        report['remote'] = remotes[0] if remotes else ''
+
+        for line in git(repo, 'status', '--porcelain').splitlines():
+            report['files'].append((line[:2].strip(), line[3:]))
+
+        refs = git(repo, 'for-each-ref', '--format=%(refname)%00%(upstream:trackshort)', 'refs/heads', 'refs/remotes')
+        branches = []
+        remote_branches = set()
+        for line in refs.splitlines():
+            name, track = line.split('\0')
+            if name.startswith('refs/heads/'):
+                branches.append(name[len('refs/heads/'):])
+                # '>' is ahead, '<>' is ahead and behind.
+                if '>' in track:
+                    report['ahead'].append(name[len('refs/heads/'):])
+            elif not name.endswith('/HEAD'):
+                remote_branches.add(name[len('refs/remotes/'):].split('/', 1)[-1])
+        report['notOnRemote'] = [branch for branch in branches if branch not in remote_branches]
+    except (OSError, RuntimeError) as error:
+        report['error'] = '{}'.format(error.args[-1] if error.args else error)
+    return report
+
+
+def is_dirty(report):
+    """
+    Tell whether a repository report has warnings. The files after fabfile are not checked, like git.check_status.
+    """
+    files = [name for status, name in report['files']]
+    if 'fabfile' in files:
+        files = files[:files.index('fabfile')]
+    return bool(report['error'] or files or report['notOnRemote'] or report['ahead'])
@@ -0,0 +1,114 @@
+#!/bin/sh
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+# Import a mysqldump file, loading its tables concurrently.
+#
+# Usage: db-import.sh <dump> <workers> <db user> <db password> <db name> [<temporary directory>]
+#
+# The dump can be plain SQL, gzip (.gz) or zstd (.zst). It is decompressed once and split per table as it
+# streams, and each table is loaded by one of <workers> mysql clients, with foreign key and unique checks
+# disabled, as soon as it is split. gzip and zstd decompress on a single thread (pigz only moves reading,
+# writing and checking to other threads), so the loads run while the rest of the dump is decompressed.
+#
+# The tables are split in the temporary directory (default: $TMPDIR or /tmp) and removed once loaded: it
+# needs room for the tables waiting for a loader. Dumps without the table comments of mysqldump, like the
+# --compact or --skip-comments ones, can not be split and are loaded by a single client.
+
+set -e
+
+dump=$1
+workers=$2
+export DB_USER=$3
+export MYSQL_PWD=$4
+export DB_NAME=$5
+tmpdir=${6:-${TMPDIR:-/tmp}}
+
+case "$dump" in
+    *.gz)  if command -v pigz > /dev/null; then decompress="pigz -dc"; else decompress="gzip -dc"; fi ;;
+    *.zst) decompress="zstd -dc" ;;
+    *)     decompress="cat" ;;
+esac
+
+# Show the decompressed throughput as it goes when pv is available.
+if command -v pv > /dev/null; then meter="pv -f -b -r -a"; else meter="cat"; fi
+
+tmp=$(mktemp -d "$tmpdir/db-import.XXXXXX")
+progress=
+trap '[ -z "$progress" ] || kill "$progress" 2> /dev/null || true; rm -rf "$tmp"' EXIT
+start=$(date +%s)
+
+printf 'SET FOREIGN_KEY_CHECKS=0;\nSET UNIQUE_CHECKS=0;\nSET autocommit=0;\n' > "$tmp/relax.sql"
+echo 'COMMIT;' > "$tmp/commit.sql"
+: > "$tmp/header.sql"
+
+rows_query="SELECT COALESCE(SUM(TABLE_ROWS), 0) FROM information_schema.TABLES WHERE TABLE_SCHEMA = '$DB_NAME'"
+
+# Report the rows loaded so far while the import runs. InnoDB only estimates them.
+(
+    while sleep 10; do
+        rows=$(mysql -u"$DB_USER" -N -e "$rows_query" 2> /dev/null) || continue
+        elapsed=$(($(date +%s) - start))
+        echo "About $rows rows loaded in ${elapsed}s: $((rows / elapsed)) rows/s."
+    done
+) &
+progress=$!
+
+# Split the dump: the SET statements before the first table go in a header replayed before every table,
+# each table goes in its own file, handed to the loaders once complete, and the views, routines and events
+# are loaded last. Tables dumped with --no-create-info start at their data.
+# sh has no pipefail: the decompressor and the split write their exit status to a file, so a truncated or
+# corrupt dump fails.
+{ $decompress "$dump" || echo $? > "$tmp/decompress.status"; } | $meter | {
+    LC_ALL=C awk -v dir="$tmp" '
+        # Close the current file and hand it to the loaders if it is a table. last.sql stays open to append to it.
+        function hand_over() {
+            if (out == dir "/last.sql") return
+            close(out)
+            if (out != dir "/header.sql") { sub(/.*\//, "", out); print out; fflush() }
+        }
+        function start_table() { hand_over(); n++; out = sprintf("%s/table-%06d.sql", dir, n) }
+        BEGIN { out = dir "/header.sql"; n = 0; bytes = 0; structure = 0 }
+        /^-- Table structure for table / { start_table(); structure = 1 }
+        /^-- Dumping data for table / { if (!structure) start_table(); structure = 0 }
+        /^-- (Temporary table|Temporary view|Final view) structure for view / || /^-- Dumping (routines|events) for database / {
+            if (out != dir "/last.sql") { hand_over(); out = dir "/last.sql" }
+            structure = 0
+        }
+        { bytes += length($0) + 1; print > out }
+        END { hand_over(); print n, bytes > (dir "/split.stats") }
+    ' || echo $? > "$tmp/split.status"
+} | xargs -r -n 1 -P "$workers" sh -c '
+    set -e
+    name=$(sed -n -e "s/^-- Table structure for table \`\(.*\)\`/\1/p" -e "s/^-- Dumping data for table \`\(.*\)\`/\1/p" "$0/$1" | head -n 1)
+    cat "$0/header.sql" "$0/relax.sql" "$0/$1" "$0/commit.sql" | mysql -u"$DB_USER" "$DB_NAME"
+    rm -f "$0/$1"
+    echo "Loaded $name"
+' "$tmp"
+
+for step in decompress split; do
+    if [ -f "$tmp/$step.status" ]; then
+        echo "Could not $step $dump (exit status $(cat "$tmp/$step.status"))." >&2
+        exit 1
+    fi
+done
+read tables bytes < "$tmp/split.stats"
+
+if [ "$tables" -eq 0 ]; then
+    # Nothing to split the dump on: it is all in the header.
+    if ! grep -q -v -e '^--' -e '^[[:space:]]*$' "$tmp/header.sql" "$tmp/last.sql" 2> /dev/null; then
+        echo "No SQL statement found in $dump." >&2
+        exit 1
+    fi
+    echo "No table comment found in $dump, loading it with a single client."
+    touch "$tmp/last.sql"
+    cat "$tmp/relax.sql" "$tmp/header.sql" "$tmp/last.sql" "$tmp/commit.sql" | mysql -u"$DB_USER" "$DB_NAME"
+elif [ -f "$tmp/last.sql" ]; then
+    cat "$tmp/header.sql" "$tmp/relax.sql" "$tmp/last.sql" "$tmp/commit.sql" | mysql -u"$DB_USER" "$DB_NAME"
+fi
+
+end=$(date +%s)
+elapsed=$((end - start))
+[ "$elapsed" -gt 0 ] || elapsed=1
+rows=$(mysql -u"$DB_USER" -N -e "$rows_query")
+echo "Imported $tables tables, $bytes bytes and about $rows rows in ${elapsed}s: $((bytes / elapsed)) bytes/s, $((rows / elapsed)) rows/s."
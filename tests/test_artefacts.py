@@ -0,0 +1,70 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from contextlib import closing
+from os import path
+
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from .. import artefacts
+
+
+class FindTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = path.join(self.directory, 'artefacts')
+        self.shas = {}
+        for build in ('build-1', 'build-2'):
+            tarball = path.join(self.directory, '{}.tar.gz'.format(build))
+            content = path.join(self.directory, 'index.php')
+            with open(content, 'w') as f:
+                f.write(build)
+            with closing(tarfile.open(tarball, 'w:gz')) as archive:
+                archive.add(content, 'index.php')
+            self.shas[build] = artefacts.add(self.store, tarball, build)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_build(self):
+        self.assertEqual(artefacts.find(self.store, build='build-1'),
+                         artefacts.store_path(self.store, self.shas['build-1']))
+
+    def test_build_is_never_a_hash(self):
+        # A missing build number must not match an archive whose hash starts like it.
+        self.assertIsNone(artefacts.find(self.store, build=self.shas['build-1'][:1]))
+        self.assertIsNone(artefacts.find(self.store, build=self.shas['build-1'][:7]))
+
+    def test_sha(self):
+        sha = self.shas['build-1']
+        self.assertEqual(artefacts.find(self.store, sha=sha[:7]), artefacts.store_path(self.store, sha))
+        self.assertEqual(artefacts.find(self.store, sha=sha), artefacts.store_path(self.store, sha))
+        self.assertRaises(ValueError, artefacts.find, self.store, sha=sha[:6])
+        self.assertRaises(ValueError, artefacts.find, self.store, sha='release')
+
+    def test_most_recent(self):
+        self.assertEqual(artefacts.find(self.store), artefacts.store_path(self.store, self.shas['build-2']))
+
+
+if __name__ == '__main__':
+    unittest.main()
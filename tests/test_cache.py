@@ -0,0 +1,59 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from fabric.api import env
+from os import path
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import cache
+
+
+class DownloadCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        env.download_cache_dir = self.directory
+        for entry in ('7.x-3.1-rc1-' + 'a' * 32, '7.x-3.1-' + 'b' * 32, '7.x-3.10-' + 'c' * 32):
+            os.makedirs(path.join(self.directory, 'views', entry, 'views'))
+            with open(path.join(self.directory, 'views', entry, 'type'), 'w') as f:
+                f.write('module')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_exact_version(self):
+        for version, entry in (('7.x-3.1', '7.x-3.1-' + 'b' * 32), ('7.x-3.1-rc1', '7.x-3.1-rc1-' + 'a' * 32)):
+            directory, project_type, hit = cache.cached_project('views', '7.x', version)
+            self.assertEqual(directory, path.join(self.directory, 'views', entry, 'views'))
+            self.assertEqual((project_type, hit), ('module', True))
+
+    def test_dev_releases_are_not_cached(self):
+        self.assertEqual(cache.cached_project('views', '7.x', '7.x-3.x-dev'), (None, None, False))
+        makefile = path.join(self.directory, 'project.make')
+        with open(makefile, 'w') as f:
+            f.write('core = 7.x\nprojects[views] = 3.1\nprojects[ctools][version] = 1.x-dev\n')
+        self.assertEqual(cache.makefile_projects(makefile), ('7.x', {'views': '7.x-3.1'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from BaseHTTPServer import BaseHTTPRequestHandler
+from fabric.api import env, hide
+from os import path
+
+import SocketServer
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+from .. import docker, docker_api
+
+
+#####################################################################
+# Fake Docker daemon on a unix socket                               #
+#####################################################################
+
+CONTAINERS = [
+    {'Names': ['/project_container'], 'State': 'running', 'Status': 'Up 5 seconds (health: starting)',
+     'NetworkSettings': {'Networks': {'bridge': {'IPAddress': '172.17.0.2'}}}},
+    {'Names': ['/project_db'], 'State': 'running', 'Status': 'Up 3 minutes (healthy)',
+     'NetworkSettings': {'Networks': {'project_net': {'IPAddress': '172.18.0.3'}}}},
+    {'Names': ['/project_data'], 'State': 'created', 'Status': 'Created', 'NetworkSettings': {'Networks': {}}},
+    {'Names': ['/project_paused'], 'State': 'paused', 'Status': 'Up 2 hours (Paused)',
+     'NetworkSettings': {'Networks': {}}},
+]
+
+IMAGES = [
+    {'RepoTags': ['project/drupal:latest', 'project/drupal:1.0']},
+    {'RepoTags': None},
+]
+
+
+class FakeDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Answer the Engine API requests of DockerClient, counting the connections it opens.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        SocketServer.UnixStreamServer.__init__(self, socket_path, FakeHandler)
+        self.connections = 0
+        # Close the connection after the next answer, without telling the client.
+        self.drop = False
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        route = self.path.split('?')[0]
+        if route == '/containers/json':
+            self._answer(200, CONTAINERS)
+        elif route == '/images/json':
+            self._answer(200, IMAGES)
+        elif route == '/containers/project_container/json':
+            self._answer(200, {'NetworkSettings': {'IPAddress': '172.17.0.2'}})
+        else:
+            self._answer(404, {'message': 'No such container'})
+        if self.server.drop:
+            self.server.drop = False
+            self.close_connection = True
+
+    def _answer(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DockerApiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = path.join(self.directory, 'docker.sock')
+        self.daemon = FakeDaemon(self.socket_path)
+        thread = threading.Thread(target=self.daemon.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = docker_api.DockerClient(self.socket_path)
+
+    def tearDown(self):
+        self.client.close()
+        self.daemon.shutdown()
+        self.daemon.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_keep_alive(self):
+        self.client.containers()
+        self.client.images()
+        self.client.inspect_container('project_container')
+        self.assertEqual(self.daemon.connections, 1)
+
+    def test_reconnect_once(self):
+        self.daemon.drop = True
+        self.assertEqual(len(self.client.containers()), len(CONTAINERS))
+        self.assertEqual(self.client.images(), IMAGES)
+        self.assertEqual(self.daemon.connections, 2)
+
+    def test_daemon_unavailable(self):
+        client = docker_api.DockerClient(path.join(self.directory, 'missing.sock'))
+        with hide('aborts'):
+            self.assertRaises(SystemExit, client.containers)
+
+    def test_not_found(self):
+        self.assertIsNone(self.client.inspect_container('missing'))
+        self.assertIsNone(self.client.inspect_image('missing'))
+
+    def test_fetch_state(self):
+        env.docker_socket = self.socket_path
+        try:
+            state = docker._fetch_state()
+        finally:
+            docker_api.client().close()
+            docker_api._client = None
+        containers = state['containers']
+        self.assertEqual(containers['project_container'], {'running': True, 'ip': '172.17.0.2', 'health': 'starting'})
+        self.assertEqual(containers['project_db'], {'running': True, 'ip': '172.18.0.3', 'health': 'healthy'})
+        self.assertEqual(containers['project_data'], {'running': False, 'ip': '', 'health': ''})
+        self.assertEqual(containers['project_paused']['health'], '')
+        self.assertEqual(state['images'], ['project/drupal', 'project/drupal', '<none>'])
+
+
+if __name__ == '__main__':
+    unittest.main()
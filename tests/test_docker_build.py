@@ -0,0 +1,51 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+
+import unittest
+
+from .. import docker
+
+
+class DockerBuildStepsTest(unittest.TestCase):
+
+    def test_legacy(self):
+        lines = [(10.0, 'Sending build context to Docker daemon  4.1kB'), (10.5, 'Step 1/3 : FROM debian'),
+                 (11.0, ' ---> 1234'), (12.5, 'Step 2/3 : RUN make'), (20.0, 'Step 3/3 : CMD run'),
+                 (20.5, 'Successfully built 5678')]
+        self.assertEqual(docker.docker_build_steps(lines),
+                         [('Step 1/3 : FROM debian', 2.0), ('Step 2/3 : RUN make', 7.5), ('Step 3/3 : CMD run', 0.5)])
+
+    def test_legacy_without_timestamps(self):
+        lines = [(None, 'Step 1/2 : FROM debian'), (None, 'Step 2/2 : RUN make')]
+        self.assertEqual(docker.docker_build_steps(lines), [('Step 1/2 : FROM debian', None),
+                                                            ('Step 2/2 : RUN make', None)])
+
+    def test_buildkit(self):
+        lines = [(None, '#1 [internal] load build definition from Dockerfile'), (None, '#1 DONE 0.1s'),
+                 (None, '#5 [1/3] FROM docker.io/library/debian'), (None, '#5 CACHED'),
+                 (None, '#6 [2/3] RUN make'), (None, '#6 0.512 compiling'), (None, '#7 [3/3] COPY conf /conf'),
+                 (None, '#6 [2/3] RUN make'), (None, '#6 DONE 12.3s'), (None, '#7 DONE 0.4s')]
+        self.assertEqual(docker.docker_build_steps(lines), [
+            ('[internal] load build definition from Dockerfile', 0.1), ('[1/3] FROM docker.io/library/debian', 0.0),
+            ('[2/3] RUN make', 12.3), ('[3/3] COPY conf /conf', 0.4)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from fabric.api import env
+from os import path
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import docker, docker_api
+
+
+class DockerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        env.builddir = self.directory
+        # No daemon answers there: the pool must not query it when there is no pool.
+        env.docker_socket = path.join(self.directory, 'missing.sock')
+        docker_api._client = None
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_pool(self):
+        self.assertIsNone(docker.docker_pool_lease())
+        docker.docker_pool_release('project_pool_1')
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+# coding: utf-8
+#
+# Copyright (C) 2016 Savoir-faire Linux Inc. (<www.savoirfairelinux.com>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+from fabric.api import env
+from contextlib import contextmanager
+from datetime import datetime
+from os import path
+
+import glob
+import json
+import os
+import time
+
+
+#####################################################################
+# Timeline of the deployment phases                                 #
+#####################################################################
+
+# Events are appended, one JSON object per line, to the file of the current deployment. Appending keeps the
+# events of the hosts deployed in parallel by forked processes.
+
+def _directory():
+    return path.join(env.builddir, 'deploys')
+
+
+def _append(event):
+    if not env.get('deploy_timeline'):
+        return
+    event['host'] = env.host_string or 'local'
+    with open(env.deploy_timeline, 'a') as f:
+        f.write(json.dumps(event) + '\n')
+
+
+def start(environment):
+    """
+    Start the timeline of a deployment to environment.
+    """
+    if not path.isdir(_directory()):
+        os.makedirs(_directory())
+    env.deploy_timeline = path.join(_directory(), '{}.jsonl'.format(datetime.now().strftime('%Y%m%d_%H%M%S')))
+    env.deploy_environment = environment
+    _append({'phase': 'deploy', 'start': time.time(), 'end': None})
+
+
+def record(name, start, end, **data):
+    """
+    Record a phase of the deployment on the current host, with optional data like the bytes transferred.
+    """
+    event = dict(data, phase=name, start=start, end=end)
+    _append(event)
+
+
+@contextmanager
+def phase(name, **data):
+    """
+    Record the block as a phase of the deployment on the current host.
+    The block can add data to the phase in the yielded dict.
+    """
+    start = time.time()
+    try:
+        yield data
+    finally:
+        record(name, start, time.time(), **data)
+
+
+def mark(name):
+    """
+    Record an instant event, like the site going offline or online.
+    """
+    now = time.time()
+    record(name, now, now)
+
+
+def _summary(events, status):
+    offline = [event['start'] for event in events if event['phase'] == 'offline']
+    online = [event['end'] for event in events if event['phase'] == 'online']
+    maintenance = max(online) - min(offline) if offline and online and max(online) > min(offline) else None
+    phases = {}
+    for event in events:
+        if event['phase'] not in ('deploy', 'offline', 'online'):
+            phases[event['phase']] = phases.get(event['phase'], 0) + event['end'] - event['start']
+    return {
+        'environment': env.get('deploy_environment'),
+        'status': status,
+        'start': events[0]['start'],
+        'end': time.time(),
+        'maintenance': maintenance,
+        'phases': phases,
+        'bytes': sum(event.get('bytes', 0) for event in events),
+        'events': events,
+    }
+
+
+def _chrome_trace(events):
+    # One row per host, phases as complete events and offline/online as instant events, in microseconds.
+    start = events[0]['start']
+    trace = []
+    for event in events:
+        args = dict((key, value) for key, value in event.items() if key not in ('phase', 'host', 'start', 'end'))
+        item = {'name': event['phase'], 'pid': 1, 'tid': event['host'], 'ts': int((event['start'] - start) * 1e6),
+                'args': args}
+        if event['phase'] in ('offline', 'online'):
+            item.update(ph='i', s='g')
+        elif event['end'] is not None:
+            item.update(ph='X', dur=int((event['end'] - event['start']) * 1e6))
+        else:
+            continue
+        trace.append(item)
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+
+def finish(status='success'):
+    """
+    Write the timeline of the deployment as JSON, and as a Chrome trace (chrome://tracing).
+    :return: the summary of the deployment
+    """
+    if not env.get('deploy_timeline'):
+        return None
+    with open(env.deploy_timeline) as f:
+        events = sorted((json.loads(line) for line in f), key=lambda event: event['start'])
+    summary = _summary(events, status)
+    base = env.deploy_timeline[:-len('.jsonl')]
+    with open('{}.json'.format(base), 'w') as f:
+        json.dump(summary, f, indent=2)
+    with open('{}.trace.json'.format(base), 'w') as f:
+        json.dump(_chrome_trace(events), f)
+    os.remove(env.deploy_timeline)
+    env.deploy_timeline = None
+    return summary
+
+
+def history(count):
+    """
+    Load the summaries of the last deployments, oldest first.
+    """
+    files = sorted(f for f in glob.glob(path.join(_directory(), '*.json')) if not f.endswith('.trace.json'))
+    summaries = []
+    for filename in files[-int(count):]:
+        with open(filename) as f:
+            summaries.append(dict(json.load(f), name=path.basename(filename)[:-len('.json')]))
+    return summaries